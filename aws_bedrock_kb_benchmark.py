@@ -0,0 +1,652 @@
+"""
+Offline benchmark harness for the AWS Bedrock Knowledge Base function.
+
+Replays conversation payloads through Pipe.pipe() against local stand-ins for
+bedrock-agent-runtime and bedrock-runtime, so throughput and latency of the hot
+path can be measured without AWS credentials or network access.
+
+Usage:
+    python aws_bedrock_kb_benchmark.py --requests requests.jsonl --concurrency 32 --total 500
+    python aws_bedrock_kb_benchmark.py --requests requests.jsonl --batch --checkpoint batch.ckpt.jsonl
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+from aws_bedrock_kb_function import Pipe
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+LOREM_WORDS = (
+    "knowledge base retrieval passage document answer context model token latency "
+    "throughput bedrock region policy customer support product guide section"
+).split()
+
+
+def _make_text(chars: int, rng: random.Random) -> str:
+    """Generate filler text of roughly the given length."""
+    words: List[str] = []
+    length = 0
+    while length < chars:
+        word = rng.choice(LOREM_WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:chars]
+
+
+class FaultInjector:
+    """
+    Shared latency and error settings for the fake clients.
+
+    Latencies are in seconds; jitter is added uniformly in [0, jitter].
+    """
+
+    def __init__(self, error_rate: float = 0.0, error_code: str = "ThrottlingException", seed: int = 0):
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sleep(self, latency: float, jitter: float = 0.0) -> None:
+        with self._lock:
+            extra = self._rng.uniform(0, jitter) if jitter else 0.0
+        time.sleep(latency + extra)
+
+    def maybe_fail(self, operation_name: str) -> None:
+        """Raise a botocore ClientError with the configured code at error_rate."""
+        with self._lock:
+            failed = self.error_rate and self._rng.random() < self.error_rate
+        if failed:
+            raise ClientError(
+                {"Error": {"Code": self.error_code, "Message": "Injected by benchmark"}},
+                operation_name,
+            )
+
+
+class FakeBedrockAgentRuntime:
+    """
+    Local stand-in for the bedrock-agent-runtime client.
+
+    RetrieveAndGenerate latencies are configured on their own (rag_latency,
+    rag_first_token_latency) rather than derived from the retrieve and invoke
+    latencies, so a mode comparison reports whatever numbers it is given.
+    """
+
+    def __init__(
+        self,
+        faults: FaultInjector,
+        latency: float = 0.15,
+        jitter: float = 0.05,
+        chunk_chars: int = 1200,
+        seed: int = 0,
+        runtime: Optional["FakeBedrockRuntime"] = None,
+        rag_latency: float = 1.1,
+        rag_first_token_latency: float = 0.4,
+    ):
+        self.faults = faults
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_chars = chunk_chars
+        self.runtime = runtime
+        self.rag_latency = rag_latency
+        self.rag_first_token_latency = rag_first_token_latency
+        self.calls = 0
+        self._session_counter = 0
+        self._lock = threading.Lock()
+        rng = random.Random(seed)
+        self._corpus = [_make_text(chunk_chars, rng) for _ in range(100)]
+
+    def retrieve(self, knowledgeBaseId: str, retrievalQuery: Dict[str, Any], retrievalConfiguration: Dict[str, Any], **kwargs: Any) -> Dict[str, Any]:
+        self.calls += 1
+        self.faults.sleep(self.latency, self.jitter)
+        self.faults.maybe_fail("Retrieve")
+        count = retrievalConfiguration.get("vectorSearchConfiguration", {}).get("numberOfResults", 5)
+        # crc32 rather than hash(): str hashes are salted per process, which would defeat --seed
+        offset = zlib.crc32(retrievalQuery.get("text", "").encode("utf-8")) % len(self._corpus)
+        return {
+            "retrievalResults": [
+                {
+                    "content": {"text": self._corpus[(offset + i) % len(self._corpus)]},
+                    "location": {
+                        "type": "S3",
+                        "s3Location": {"uri": f"s3://benchmark/{knowledgeBaseId}/doc-{(offset + i) % len(self._corpus)}.txt"},
+                    },
+                    "score": 1.0 - i / (count + 1),
+                }
+                for i in range(count)
+            ]
+        }
+
+    def _session_id(self, kwargs: Dict[str, Any]) -> str:
+        if kwargs.get("sessionId"):
+            return kwargs["sessionId"]
+        with self._lock:
+            self._session_counter += 1
+            return f"benchmark-session-{self._session_counter}"
+
+    def retrieve_and_generate(self, **kwargs: Any) -> Dict[str, Any]:
+        if self.runtime is None:
+            raise RuntimeError("retrieve_and_generate needs a FakeBedrockRuntime")
+        self.calls += 1
+        self.faults.sleep(self.rag_latency, self.jitter)
+        self.faults.maybe_fail("RetrieveAndGenerate")
+        return {"output": {"text": self.runtime.answer}, "sessionId": self._session_id(kwargs), "citations": []}
+
+    def retrieve_and_generate_stream(self, **kwargs: Any) -> Dict[str, Any]:
+        if self.runtime is None:
+            raise RuntimeError("retrieve_and_generate_stream needs a FakeBedrockRuntime")
+        self.calls += 1
+        self.faults.maybe_fail("RetrieveAndGenerateStream")
+        step = self.runtime.stream_chunk_chars
+        answer = self.runtime.answer
+        events = [{"output": {"text": answer[i:i + step]}} for i in range(0, len(answer), step)]
+        chunk_latency = max(0.0, self.rag_latency - self.rag_first_token_latency) / max(1, len(events) - 1)
+        return {
+            "stream": _FakeEventStream(events, self.faults, self.rag_first_token_latency, chunk_latency, raw=True),
+            "sessionId": self._session_id(kwargs),
+        }
+
+
+class _FakeStreamingBody:
+    def __init__(self, payload: bytes):
+        self._payload = payload
+
+    def read(self) -> bytes:
+        return self._payload
+
+
+class _FakeEventStream:
+    def __init__(
+        self,
+        events: List[Dict[str, Any]],
+        faults: FaultInjector,
+        first_latency: float,
+        chunk_latency: float,
+        raw: bool = False,
+    ):
+        self._events = events
+        self._faults = faults
+        self._first_latency = first_latency
+        self._chunk_latency = chunk_latency
+        # invoke_model streams wrap JSON in chunk bytes; agent runtime streams yield events as-is
+        self._raw = raw
+        self.closed = False
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for index, event in enumerate(self._events):
+            if self.closed:
+                return
+            self._faults.sleep(self._first_latency if index == 0 else self._chunk_latency)
+            yield event if self._raw else {"chunk": {"bytes": json.dumps(event).encode("utf-8")}}
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class FakeBedrockRuntime:
+    """
+    Local stand-in for the bedrock-runtime client.
+
+    Responses follow the Claude 3 Messages or Amazon Nova format depending on
+    the model ID, including token count headers and streaming invocation metrics.
+    converse and converse_stream answer for any model ID.
+
+    Prompt caching is simulated: the prompt up to the last cache checkpoint is
+    remembered, and a request repeating it reports cache read tokens and gets
+    cache_speedup of its first-token latency taken off.
+    """
+
+    def __init__(
+        self,
+        faults: FaultInjector,
+        latency: float = 1.0,
+        jitter: float = 0.2,
+        output_chars: int = 1500,
+        first_token_latency: float = 0.3,
+        stream_chunk_chars: int = 40,
+        seed: int = 0,
+        cache_speedup: float = 0.5,
+    ):
+        self.faults = faults
+        self.latency = latency
+        self.jitter = jitter
+        self.output_chars = output_chars
+        self.first_token_latency = first_token_latency
+        self.stream_chunk_chars = stream_chunk_chars
+        self.cache_speedup = cache_speedup
+        self.calls = 0
+        self.answer = _make_text(output_chars, random.Random(seed + 1))
+        self._prompt_cache: set = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _is_nova(model_id: str) -> bool:
+        return "amazon.nova" in model_id
+
+    def _prompt_cache_usage(self, request: Dict[str, Any]) -> Tuple[int, int]:
+        """Return (cache read tokens, cache write tokens) for a request's last cache checkpoint."""
+        blocks = list(request.get("system") or [])
+        for message in request.get("messages", []):
+            content = message.get("content")
+            blocks += content if isinstance(content, list) else [{"text": content}]
+        seen: List[str] = []
+        prefix = None
+        for block in blocks:
+            if "text" in block:
+                seen.append(block["text"])
+            if "cache_control" in block or "cachePoint" in block:
+                prefix = "".join(seen)
+        if prefix is None:
+            return 0, 0
+        with self._lock:
+            if prefix in self._prompt_cache:
+                return len(prefix) // 4, 0
+            self._prompt_cache.add(prefix)
+        return 0, len(prefix) // 4
+
+    def _usage_headers(self, body: str, cache_usage: Tuple[int, int]) -> Dict[str, Any]:
+        return {
+            "HTTPHeaders": {
+                "x-amzn-bedrock-input-token-count": str(len(body) // 4),
+                "x-amzn-bedrock-output-token-count": str(len(self.answer) // 4),
+                "x-amzn-bedrock-cache-read-input-token-count": str(cache_usage[0]),
+                "x-amzn-bedrock-cache-write-input-token-count": str(cache_usage[1]),
+            }
+        }
+
+    def _first_token_latency(self, cache_usage: Tuple[int, int]) -> float:
+        return self.first_token_latency * (1 - self.cache_speedup) if cache_usage[0] else self.first_token_latency
+
+    def invoke_model(self, modelId: str, body: str, **kwargs: Any) -> Dict[str, Any]:
+        self.calls += 1
+        cache_usage = self._prompt_cache_usage(json.loads(body))
+        self.faults.sleep(self.latency - self.first_token_latency + self._first_token_latency(cache_usage), self.jitter)
+        self.faults.maybe_fail("InvokeModel")
+        if self._is_nova(modelId):
+            response = {"output": {"message": {"role": "assistant", "content": [{"text": self.answer}]}}}
+        else:
+            response = {"content": [{"type": "text", "text": self.answer}]}
+        return {
+            "body": _FakeStreamingBody(json.dumps(response).encode("utf-8")),
+            "ResponseMetadata": self._usage_headers(body, cache_usage),
+        }
+
+    def invoke_model_with_response_stream(self, modelId: str, body: str, **kwargs: Any) -> Dict[str, Any]:
+        self.calls += 1
+        self.faults.maybe_fail("InvokeModelWithResponseStream")
+        cache_usage = self._prompt_cache_usage(json.loads(body))
+        step = self.stream_chunk_chars
+        pieces = [self.answer[i:i + step] for i in range(0, len(self.answer), step)]
+        if self._is_nova(modelId):
+            events = [{"messageStart": {"role": "assistant"}}]
+            events += [{"contentBlockDelta": {"delta": {"text": piece}, "contentBlockIndex": 0}} for piece in pieces]
+            events.append({"messageStop": {"stopReason": "end_turn"}})
+        else:
+            events = [{"type": "message_start"}]
+            events += [{"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": piece}} for piece in pieces]
+            events.append({"type": "message_stop"})
+        events[-1]["amazon-bedrock-invocationMetrics"] = {
+            "inputTokenCount": len(body) // 4,
+            "outputTokenCount": len(self.answer) // 4,
+            "cacheReadInputTokenCount": cache_usage[0],
+            "cacheWriteInputTokenCount": cache_usage[1],
+        }
+        chunk_latency = max(0.0, self.latency - self.first_token_latency) / max(1, len(events) - 1)
+        return {"body": _FakeEventStream(events, self.faults, self._first_token_latency(cache_usage), chunk_latency)}
+
+    def _converse_usage(self, messages: List[Dict[str, Any]], cache_usage: Tuple[int, int]) -> Dict[str, int]:
+        return {
+            "inputTokens": len(json.dumps(messages)) // 4,
+            "outputTokens": len(self.answer) // 4,
+            "cacheReadInputTokens": cache_usage[0],
+            "cacheWriteInputTokens": cache_usage[1],
+        }
+
+    def converse(self, modelId: str, messages: List[Dict[str, Any]], **kwargs: Any) -> Dict[str, Any]:
+        self.calls += 1
+        cache_usage = self._prompt_cache_usage({"system": kwargs.get("system"), "messages": messages})
+        self.faults.sleep(self.latency - self.first_token_latency + self._first_token_latency(cache_usage), self.jitter)
+        self.faults.maybe_fail("Converse")
+        return {
+            "output": {"message": {"role": "assistant", "content": [{"text": self.answer}]}},
+            "stopReason": "end_turn",
+            "usage": self._converse_usage(messages, cache_usage),
+        }
+
+    def converse_stream(self, modelId: str, messages: List[Dict[str, Any]], **kwargs: Any) -> Dict[str, Any]:
+        self.calls += 1
+        self.faults.maybe_fail("ConverseStream")
+        cache_usage = self._prompt_cache_usage({"system": kwargs.get("system"), "messages": messages})
+        step = self.stream_chunk_chars
+        events: List[Dict[str, Any]] = [{"messageStart": {"role": "assistant"}}]
+        events += [
+            {"contentBlockDelta": {"delta": {"text": self.answer[i:i + step]}, "contentBlockIndex": 0}}
+            for i in range(0, len(self.answer), step)
+        ]
+        events.append({"messageStop": {"stopReason": "end_turn"}})
+        events.append({"metadata": {"usage": self._converse_usage(messages, cache_usage)}})
+        chunk_latency = max(0.0, self.latency - self.first_token_latency) / max(1, len(events) - 1)
+        return {
+            "stream": _FakeEventStream(
+                events, self.faults, self._first_token_latency(cache_usage), chunk_latency, raw=True
+            )
+        }
+
+
+class FakeS3:
+    """Local stand-in for the S3 client; keeps uploaded objects in memory."""
+
+    def __init__(self):
+        self.objects: Dict[str, bytes] = {}
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes, **kwargs: Any) -> Dict[str, Any]:
+        self.objects[f"s3://{Bucket}/{Key}"] = Body
+        return {"ETag": f'"{zlib.crc32(Body):08x}"'}
+
+
+class FakeBedrock:
+    """Local stand-in for the bedrock control plane client (batch inference jobs only)."""
+
+    def __init__(self):
+        self.jobs: List[Dict[str, Any]] = []
+
+    def create_model_invocation_job(self, **kwargs: Any) -> Dict[str, Any]:
+        self.jobs.append(kwargs)
+        return {"jobArn": f"arn:aws:bedrock:us-east-1:000000000000:model-invocation-job/benchmark-{len(self.jobs)}"}
+
+
+def load_payloads(path: str) -> List[Dict[str, Any]]:
+    """
+    Load conversation payloads from a JSONL file.
+
+    Lines that already contain 'messages' are used as request bodies. Other lines
+    (e.g. with 'title' and 'body') are turned into a single user message. A
+    line's request_id (or id) is kept, so batch checkpoints stay valid when the
+    file is reordered or edited.
+
+    Args:
+        path: Path to the JSONL file
+
+    Returns:
+        List of OpenWebUI request bodies
+    """
+    payloads = []
+    with open(path, encoding="utf-8") as handle:
+        for line in handle:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if "messages" in record:
+                payload = {"messages": record["messages"]}
+            else:
+                question = "\n\n".join(str(record[field]) for field in ("title", "body") if record.get(field))
+                payload = {"messages": [{"role": "user", "content": question or json.dumps(record)}]}
+            request_id = record.get("request_id") or record.get("id")
+            if request_id:
+                payload["request_id"] = str(request_id)
+            payloads.append(payload)
+    return payloads
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident set size of this process in MiB, if the platform reports it."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+async def run_benchmark(
+    pipe: Pipe,
+    payloads: List[Dict[str, Any]],
+    concurrency: int = 16,
+    total: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Replay payloads through pipe.pipe() with bounded concurrency.
+
+    Args:
+        pipe: A configured Pipe (typically with fake clients pinned via set_client)
+        payloads: Request bodies to replay; cycled if total exceeds their number
+        concurrency: Number of requests in flight at once
+        total: Number of requests to send (defaults to len(payloads))
+
+    Returns:
+        Report with latency percentiles in milliseconds, requests per second,
+        error count and peak RSS
+    """
+    total = total or len(payloads)
+    queue: "asyncio.Queue[int]" = asyncio.Queue()
+    for index in range(total):
+        queue.put_nowait(index)
+    latencies: List[float] = []
+    first_token_latencies: List[float] = []
+    errors = 0
+
+    async def worker() -> None:
+        nonlocal errors
+        while True:
+            try:
+                index = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            source = payloads[index % len(payloads)]
+            body = {"messages": [dict(message) for message in source["messages"]]}
+            started_at = time.perf_counter()
+            result = await pipe.pipe(body)
+            if hasattr(result, "__aiter__"):
+                first_token_seen = False
+                async for _ in result:
+                    if not first_token_seen:
+                        first_token_latencies.append(time.perf_counter() - started_at)
+                        first_token_seen = True
+                answer = body["messages"][-1]["content"]
+            else:
+                answer = result
+            latencies.append(time.perf_counter() - started_at)
+            if isinstance(answer, dict) or str(answer).startswith(("Error", "AWS Bedrock")):
+                errors += 1
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started_at
+
+    latencies.sort()
+    first_token_latencies.sort()
+    report = {
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_second": round(total / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    counters = pipe.metrics.snapshot()["counters"]
+    report["cache_read_tokens"] = int(counters.get(("cache_read_input_tokens_total", ()), 0))
+    report["cache_write_tokens"] = int(counters.get(("cache_write_input_tokens_total", ()), 0))
+    if first_token_latencies:
+        report["first_token_p50_ms"] = round(percentile(first_token_latencies, 0.50) * 1000, 1)
+        report["first_token_p95_ms"] = round(percentile(first_token_latencies, 0.95) * 1000, 1)
+    return report
+
+
+async def run_batch(
+    pipe: Pipe,
+    payloads: List[Dict[str, Any]],
+    concurrency: int = 16,
+    checkpoint_path: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Answer payloads through pipe.batch_query() and report throughput.
+
+    Args:
+        pipe: A configured Pipe (typically with fake clients pinned via set_client)
+        payloads: Request bodies to answer, one batch item each
+        concurrency: Items processed at once
+        checkpoint_path: Checkpoint file, so a rerun skips finished items
+
+    Returns:
+        Report with item count, errors, latency percentiles and items per second
+    """
+    latencies: List[float] = []
+    errors = 0
+    started_at = time.perf_counter()
+    async for result in pipe.batch_query(payloads, concurrency, checkpoint_path):
+        latencies.append(result["latency_ms"])
+        if result["error"]:
+            errors += 1
+    elapsed = time.perf_counter() - started_at
+
+    latencies.sort()
+    return {
+        "items": len(latencies),
+        "concurrency": concurrency,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "items_per_second": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def build_pipe(args: argparse.Namespace) -> Pipe:
+    """Create a Pipe wired to fake clients according to the command line options."""
+    faults = FaultInjector(args.error_rate, args.error_code, args.seed)
+    runtime = FakeBedrockRuntime(
+        faults, args.invoke_latency, args.jitter, args.output_chars, args.first_token_latency, seed=args.seed
+    )
+    pipe = Pipe()
+    pipe.valves = pipe.Valves(
+        aws_access_key_id="benchmark",
+        aws_secret_access_key="benchmark",
+        knowledge_base_id=args.knowledge_base_id,
+        model_id=args.model_id,
+        number_of_results=args.number_of_results,
+        enable_streaming=args.stream,
+        generation_mode=args.mode,
+        enable_retrieval_cache=not args.disable_caches,
+        enable_response_cache=False if args.disable_caches else pipe.valves.enable_response_cache,
+        max_concurrent_requests=args.max_concurrent_requests,
+        enable_status_indicator=False,
+        enable_prompt_caching=args.prompt_caching,
+    )
+    pipe.set_client(
+        "bedrock-agent-runtime",
+        FakeBedrockAgentRuntime(
+            faults,
+            args.retrieve_latency,
+            args.jitter,
+            args.chunk_chars,
+            args.seed,
+            runtime=runtime,
+            rag_latency=args.rag_latency,
+            rag_first_token_latency=args.rag_first_token_latency,
+        ),
+    )
+    pipe.set_client("bedrock-runtime", runtime)
+    pipe.set_client("bedrock", FakeBedrock())
+    pipe.set_client("s3", FakeS3())
+    return pipe
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the AWS Bedrock Knowledge Base pipe offline")
+    parser.add_argument("--requests", default="requests.jsonl", help="JSONL file with payloads to replay")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight at once")
+    parser.add_argument("--total", type=int, default=None, help="Total requests (default: one per payload)")
+    parser.add_argument("--stream", action="store_true", help="Enable the streaming valve")
+    parser.add_argument(
+        "--mode",
+        default="retrieve_then_generate",
+        choices=["retrieve_then_generate", "retrieve_and_generate"],
+        help="Value for the generation_mode valve",
+    )
+    parser.add_argument("--batch", action="store_true", help="Answer the payloads through Pipe.batch_query()")
+    parser.add_argument("--checkpoint", default=None, help="Checkpoint file for --batch (reruns skip finished items)")
+    parser.add_argument(
+        "--compare-modes",
+        action="store_true",
+        help="Run both generation modes and report each (RetrieveAndGenerate latency is synthetic, see --rag-latency)",
+    )
+    parser.add_argument("--model-id", default="anthropic.claude-3-sonnet-20240229-v1:0")
+    parser.add_argument("--knowledge-base-id", default="BENCHMARKKB")
+    parser.add_argument("--number-of-results", type=int, default=5)
+    parser.add_argument("--max-concurrent-requests", type=int, default=16, help="Pipe thread pool size")
+    parser.add_argument("--retrieve-latency", type=float, default=0.15, help="Seconds per retrieve call")
+    parser.add_argument("--invoke-latency", type=float, default=1.0, help="Seconds per model invocation")
+    parser.add_argument("--first-token-latency", type=float, default=0.3, help="Seconds to first streamed chunk")
+    parser.add_argument("--jitter", type=float, default=0.05, help="Uniform latency jitter in seconds")
+    parser.add_argument(
+        "--rag-latency", type=float, default=1.1, help="Seconds per fake RetrieveAndGenerate call (synthetic)"
+    )
+    parser.add_argument(
+        "--rag-first-token-latency",
+        type=float,
+        default=0.4,
+        help="Seconds to the first chunk of a fake RetrieveAndGenerateStream call (synthetic)",
+    )
+    parser.add_argument("--chunk-chars", type=int, default=1200, help="Characters per retrieved chunk")
+    parser.add_argument("--output-chars", type=int, default=1500, help="Characters per generated answer")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls that fail")
+    parser.add_argument("--error-code", default="ThrottlingException", help="Error code for injected failures")
+    parser.add_argument("--prompt-caching", action="store_true", help="Enable Bedrock prompt cache checkpoints (ignored for models without prompt caching support)")
+    parser.add_argument("--disable-caches", action="store_true", help="Turn off retrieval and response caches")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    payloads = load_payloads(args.requests)
+    if not payloads:
+        raise SystemExit(f"No payloads found in {args.requests}")
+    modes = ["retrieve_then_generate", "retrieve_and_generate"] if args.compare_modes else [args.mode]
+    for mode in modes:
+        args.mode = mode
+        pipe = build_pipe(args)
+        if args.batch:
+            report = asyncio.run(run_batch(pipe, payloads, args.concurrency, args.checkpoint))
+        else:
+            report = asyncio.run(run_benchmark(pipe, payloads, args.concurrency, args.total))
+        report["mode"] = mode
+        if mode == "retrieve_and_generate":
+            report["note"] = (
+                "synthetic: RetrieveAndGenerate latency comes from --rag-latency/--rag-first-token-latency, "
+                "not from a measurement"
+            )
+        if args.json:
+            print(json.dumps(report))
+        else:
+            for key, value in report.items():
+                print(f"{key:>22}: {value}")
+            print()
+
+
+if __name__ == "__main__":
+    main()
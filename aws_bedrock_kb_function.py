@@ -3,433 +3,4695 @@ title: AWS Bedrock Knowledge Base Function
 author: Aaron Bolton
 author_url: https://github.com/d3v0ps-cloud/AWS-Bedrock-Knowledge-Base-Function
 version: 0.1.1
-description: Integration with AWS Bedrock Knowledge Base for OpenWebUI only support for Claude 3 models.
+description: Integration with AWS Bedrock Knowledge Base for OpenWebUI. Claude 3 and Amazon Nova models are called natively, other Bedrock models through the Converse API.
 This module defines a Pipe class that utilizes AWS Bedrock Knowledge Base for retrieving information
 from your documents and providing AI-generated responses.
 """
+import asyncio
+import bisect
+import functools
+import hashlib
 import json
+import logging
+import math
 import os
+import random
+import re
+import sqlite3
+import threading
 import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from enum import Enum
-from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
 
-import boto
-from botocore.exceptions import ClientError
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectTimeoutError, EndpointConnectionError
 from pydantic import BaseModel, Field, validator
 
+try:
+    import numpy as np
+except ImportError:  # Optional; BM25 reranking falls back to pure Python
+    np = None
+
+logger = logging.getLogger(__name__)
 
 # Constants for model families
 class ModelFamily(str, Enum):
     CLAUDE3 = "anthropic.claude-3"
     NOVA = "amazon.nova"
+    CONVERSE = "converse"
 
-def extract_event_info(event_emitter) -> Tuple[Optional[str], Optional[str]]:
+GENERATION_MODES = ("retrieve_then_generate", "retrieve_and_generate")
+
+NO_RESULTS_MESSAGE = "I couldn't find any relevant information in the knowledge base."
+# Input tokens always left for retrieved passages; history is shrunk to make room
+MIN_CONTEXT_TOKENS = 128
+
+# Backoff after a failed history summary, doubling per consecutive failure
+SUMMARY_RETRY_BASE_SECONDS = 30.0
+SUMMARY_RETRY_MAX_SECONDS = 900.0
+
+HISTORY_SUMMARY_PROMPT = """Summarize the conversation below between a user and an assistant in a few sentences.
+Keep facts, names, numbers and open questions that may be needed to answer follow-up questions.
+
+Summary so far:
+{summary}
+
+New conversation turns:
+{turns}
+Summary:"""
+
+QUERY_REWRITE_PROMPT = """Rewrite the latest user question as a standalone search query for a knowledge base, resolving references to the conversation below.
+{instruction}
+Reply with one query per line and nothing else.
+
+{history}
+
+Latest question:
+{question}
+Queries:"""
+
+SYSTEM_PROMPT = (
+    "You answer questions using information retrieved from a knowledge base. "
+    "If the information doesn't contain a clear answer, please say so."
+)
+
+class PromptParts(NamedTuple):
     """
-    Extract chat_id and message_id from event emitter closure.
+    A generation prompt split by how often its parts change.
+    
+    The system instructions never change, the retrieved context and history
+    often repeat across turns of a chat, and the question changes every time.
+    Keeping them in this order lets Bedrock prompt caching reuse the prefix.
+    """
+    
+    system: str
+    context: str
+    history: str
+    question: str
+    
+    def text(self) -> str:
+        """The whole prompt as one string (for token estimates)."""
+        return "\n\n".join(part for part in self if part)
+
+INFERENCE_PROFILE_PREFIXES = ("us", "eu", "apac", "us-gov")
+
+def base_model_id(model_id: str) -> str:
+    """
+    Strip a cross-region inference profile prefix (us., eu., apac., ...) from a model ID.
     
     Args:
-        event_emitter: The event emitter function with closure containing request info
+        model_id: A foundation model or inference profile ID
         
     Returns:
-        Tuple containing chat_id and message_id, both can be None if not found
+        The foundation model ID
     """
-    if not event_emitter or not event_emitter.__closure__:
-        return None, None
-    for cell in event_emitter.__closure__:
-        if isinstance(request_info := cell.cell_contents, dict):
-            chat_id = request_info.get("chat_id")
-            message_id = request_info.get("message_id")
-            return chat_id, message_id
-    return None, None
+    prefix, _, rest = model_id.partition(".")
+    return rest if rest and prefix in INFERENCE_PROFILE_PREFIXES else model_id
 
-class Pipe:
-    class Valves(BaseModel):
-        aws_access_key_id: str = Field(
-            default="", description="AWS Access Key ID"
-        )
-        aws_secret_access_key: str = Field(
-            default="", description="AWS Secret Access Key"
-        )
-        aws_session_token: str = Field(
-            default="", description="AWS Session Token (optional, for temporary credentials)"
-        )
-        aws_region: str = Field(
-            default="eu-west-1", description="AWS Region"
-        )
-        knowledge_base_id: str = Field(
-            default="", description="AWS Bedrock Knowledge Base ID"
-        )
-        model_id: str = Field(
-            default="anthropic.claude-3-sonnet-20240229-v1:0",
-            description="Model ID to use for retrieval"
-        )
-        max_tokens: int = Field(
-            default=4096, description="Maximum number of tokens in the response"
-        )
-        temperature: float = Field(
-            default=0.7, description="Temperature for model generation"
-        )
-        top_p: float = Field(
-            default=0.9, description="Top-p sampling parameter"
-        )
-        number_of_results: int = Field(
-            default=5, description="Number of knowledge base results to retrieve"
-        )
-        use_conversation_history: bool = Field(
-            default=True, description="Whether to include conversation history for context"
-        )
-        max_history_messages: int = Field(
-            default=10, description="Maximum number of previous messages to include in history"
-        )
-        emit_interval: float = Field(
-            default=2.0, description="Interval in seconds between status emissions"
-        )
-        enable_status_indicator: bool = Field(
-            default=True, description="Enable or disable status indicator emissions"
+class ModelCodec(ABC):
+    """
+    Translates prompts into model requests and model responses back into text.
+    
+    Subclasses cover one model family each. Codecs are stateless and shared, so
+    they are resolved once per model ID by resolve_model_codec().
+    """
+    
+    family = ""
+    uses_converse = False
+    
+    @abstractmethod
+    def request_body(
+        self,
+        prompt: Union[str, PromptParts],
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        cache: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Build the request for a prompt.
+        
+        Args:
+            prompt: The prompt text, or its parts to send as separate blocks
+            max_tokens: Response token limit
+            temperature: Sampling temperature
+            top_p: Nucleus sampling probability
+            cache: Whether to mark prompt caching checkpoints after the system,
+                context and history blocks
+            
+        Returns:
+            The invoke_model body, or the converse arguments for Converse codecs
+        """
+    
+    @abstractmethod
+    def parse_response(self, response_body: Dict[str, Any]) -> str:
+        """Extract the generated text from a complete response."""
+    
+    def stream_payload(self, event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Decode a raw stream event into the model's event payload (None to skip it)."""
+        chunk = event.get('chunk')
+        return json.loads(chunk['bytes']) if chunk else None
+    
+    @abstractmethod
+    def decode_stream_chunk(self, payload: Dict[str, Any]) -> Optional[str]:
+        """Extract the text delta from a stream event payload (None for events without text)."""
+    
+    def stream_usage(self, payload: Dict[str, Any]) -> Optional[Dict[str, int]]:
+        """Extract token usage from a stream event payload, if it carries any."""
+        invocation_metrics = payload.get('amazon-bedrock-invocationMetrics')
+        if not invocation_metrics:
+            return None
+        return {
+            'input_tokens': invocation_metrics.get('inputTokenCount', 0),
+            'output_tokens': invocation_metrics.get('outputTokenCount', 0),
+            'cache_read_tokens': invocation_metrics.get('cacheReadInputTokenCount', 0),
+            'cache_write_tokens': invocation_metrics.get('cacheWriteInputTokenCount', 0),
+        }
+
+class Claude3Codec(ModelCodec):
+    """Anthropic Claude 3 models through the native Messages API."""
+    
+    family = ModelFamily.CLAUDE3
+    
+    def request_body(
+        self,
+        prompt: Union[str, PromptParts],
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        cache: bool = False,
+    ) -> Dict[str, Any]:
+        body: Dict[str, Any] = {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+        }
+        if isinstance(prompt, str):
+            body["messages"] = [{"role": "user", "content": prompt}]
+            return body
+        
+        def block(text: str, checkpoint: bool) -> Dict[str, Any]:
+            content = {"type": "text", "text": text}
+            if checkpoint and cache:
+                content["cache_control"] = {"type": "ephemeral"}
+            return content
+        
+        body["system"] = [block(prompt.system, True)]
+        body["messages"] = [
+            {
+                "role": "user",
+                "content": [
+                    *(block(text, True) for text in (prompt.context, prompt.history) if text),
+                    block(prompt.question, False),
+                ],
+            }
+        ]
+        return body
+    
+    def parse_response(self, response_body: Dict[str, Any]) -> str:
+        return response_body['content'][0]['text']
+    
+    def decode_stream_chunk(self, payload: Dict[str, Any]) -> Optional[str]:
+        if payload.get("type") == "content_block_delta":
+            return payload.get("delta", {}).get("text")
+        return None
+
+class NovaCodec(ModelCodec):
+    """Amazon Nova models through the native messages-v1 schema."""
+    
+    family = ModelFamily.NOVA
+    
+    @staticmethod
+    def prompt_blocks(
+        prompt: Union[str, PromptParts], cache: bool
+    ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """
+        Split a prompt into system and user content blocks with optional cachePoint markers.
+        
+        Args:
+            prompt: The prompt text, or its parts
+            cache: Whether to add cachePoint markers
+            
+        Returns:
+            Tuple of (system blocks, user message content blocks)
+        """
+        if isinstance(prompt, str):
+            return [], [{"text": prompt}]
+        checkpoint = [{"cachePoint": {"type": "default"}}] if cache else []
+        system = [{"text": prompt.system}, *checkpoint]
+        content: List[Dict[str, Any]] = []
+        for text in (prompt.context, prompt.history):
+            if text:
+                content += [{"text": text}, *checkpoint]
+        content.append({"text": prompt.question})
+        return system, content
+    
+    def request_body(
+        self,
+        prompt: Union[str, PromptParts],
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        cache: bool = False,
+    ) -> Dict[str, Any]:
+        system, content = self.prompt_blocks(prompt, cache)
+        body: Dict[str, Any] = {"schemaVersion": "messages-v1"}
+        if system:
+            body["system"] = system
+        body["messages"] = [{"role": "user", "content": content}]
+        body["inferenceConfig"] = {
+            "max_new_tokens": max_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+        }
+        return body
+    
+    def parse_response(self, response_body: Dict[str, Any]) -> str:
+        content = response_body.get("output", {}).get("message", {}).get("content", [])
+        return "".join(block.get("text", "") for block in content)
+    
+    def decode_stream_chunk(self, payload: Dict[str, Any]) -> Optional[str]:
+        if "contentBlockDelta" in payload:
+            return payload["contentBlockDelta"].get("delta", {}).get("text")
+        return None
+
+class ConverseCodec(NovaCodec):
+    """
+    Any other Bedrock model through the model-independent Converse API.
+    
+    Converse events and responses have the same content shape as Nova, but
+    arrive as parsed dictionaries and report usage in their own fields.
+    """
+    
+    family = ModelFamily.CONVERSE
+    uses_converse = True
+    
+    def request_body(
+        self,
+        prompt: Union[str, PromptParts],
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        cache: bool = False,
+    ) -> Dict[str, Any]:
+        system, content = self.prompt_blocks(prompt, cache)
+        request: Dict[str, Any] = {}
+        if system:
+            request["system"] = system
+        request["messages"] = [{"role": "user", "content": content}]
+        request["inferenceConfig"] = {
+            "maxTokens": max_tokens,
+            "temperature": temperature,
+            "topP": top_p,
+        }
+        return request
+    
+    def stream_payload(self, event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        return event
+    
+    def stream_usage(self, payload: Dict[str, Any]) -> Optional[Dict[str, int]]:
+        usage = payload.get('metadata', {}).get('usage')
+        return self.response_usage({'usage': usage}) if usage else None
+    
+    @staticmethod
+    def response_usage(response: Dict[str, Any]) -> Dict[str, int]:
+        """Token usage of a converse response."""
+        usage = response.get('usage', {})
+        return {
+            'input_tokens': usage.get('inputTokens', 0),
+            'output_tokens': usage.get('outputTokens', 0),
+            'cache_read_tokens': usage.get('cacheReadInputTokens', 0),
+            'cache_write_tokens': usage.get('cacheWriteInputTokens', 0),
+        }
+
+MODEL_CODECS: Tuple[Tuple[str, ModelCodec], ...] = (
+    (ModelFamily.CLAUDE3.value, Claude3Codec()),
+    (ModelFamily.NOVA.value, NovaCodec()),
+)
+
+CONVERSE_CODEC = ConverseCodec()
+
+@functools.lru_cache(maxsize=64)
+def resolve_model_codec(model_id: str) -> ModelCodec:
+    """
+    Find the codec for a model ID, ignoring cross-region inference profile prefixes.
+    
+    Models without a native codec (including ARNs) use the Converse API.
+    
+    Args:
+        model_id: A foundation model ID, inference profile ID or ARN
+        
+    Returns:
+        The shared codec instance
+    """
+    base_id = base_model_id(model_id)
+    for prefix, codec in MODEL_CODECS:
+        if base_id.startswith(prefix):
+            return codec
+    return CONVERSE_CODEC
+
+# Foundation model ID prefixes that accept prompt cache checkpoints on Bedrock;
+# other models reject cache_control / cachePoint blocks
+PROMPT_CACHING_MODELS = (
+    "anthropic.claude-3-5-haiku-20241022",
+    "anthropic.claude-3-7-sonnet-20250219",
+    "anthropic.claude-sonnet-4",
+    "anthropic.claude-opus-4",
+    "anthropic.claude-haiku-4",
+    "amazon.nova-micro",
+    "amazon.nova-lite",
+    "amazon.nova-pro",
+    "amazon.nova-premier",
+)
+
+@functools.lru_cache(maxsize=64)
+def supports_prompt_caching(model_id: str) -> bool:
+    """
+    Whether Bedrock accepts prompt cache checkpoints for a model, ignoring inference profile prefixes.
+    
+    Args:
+        model_id: A foundation model ID, inference profile ID or ARN
+        
+    Returns:
+        True if the model is on the PROMPT_CACHING_MODELS allow-list
+    """
+    return base_model_id(model_id).startswith(PROMPT_CACHING_MODELS)
+
+def normalize_query(query: str) -> str:
+    """
+    Normalize query text so trivially different phrasings share a cache entry.
+    
+    Case, repeated whitespace and trailing punctuation are ignored.
+    
+    Args:
+        query: The raw query text
+        
+    Returns:
+        The normalized query text
+    """
+    return " ".join(query.casefold().split()).rstrip("?!.,;: ")
+
+LIST_MARKER_PATTERN = re.compile(r"^\s*(?:[-*\u2022]|\d+[.)])\s*")
+
+def parse_rewritten_queries(text: str, limit: int) -> List[str]:
+    """
+    Extract search queries from a query rewrite model response.
+    
+    List markers and quotes are stripped, and queries that only differ in case,
+    whitespace or trailing punctuation are kept once.
+    
+    Args:
+        text: The model response, one query per line
+        limit: Maximum number of queries to return
+        
+    Returns:
+        The queries in response order
+    """
+    queries: List[str] = []
+    seen = set()
+    for line in text.splitlines():
+        query = LIST_MARKER_PATTERN.sub("", line).strip().strip('"\'').strip()
+        key = normalize_query(query)
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        queries.append(query)
+        if len(queries) >= limit:
+            break
+    return queries
+
+RETRYABLE_ERROR_CODES = frozenset({
+    "ThrottlingException",
+    "ServiceQuotaExceededException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException",
+    "InternalServerException",
+})
+
+# Retryable codes that signal load rather than a degraded service; they are
+# retried but never counted by the circuit breaker.
+THROTTLING_ERROR_CODES = frozenset({
+    "ThrottlingException",
+    "ServiceQuotaExceededException",
+    "TooManyRequestsException",
+})
+
+def estimate_tokens(text: str) -> int:
+    """
+    Roughly estimate the number of model tokens in a text.
+    
+    Uses the common approximation of four characters per token, which is close
+    enough for budgeting and rate limiting without a tokenizer dependency.
+    
+    Args:
+        text: The text to estimate
+        
+    Returns:
+        Estimated token count (at least 1 for non-empty text)
+    """
+    return (len(text) + 3) // 4
+
+class CircuitOpenError(Exception):
+    """Raised when AWS Bedrock calls are short-circuited because the service looks degraded."""
+
+class BedrockRequestError(Exception):
+    """Raised with a user-facing message when answering a question fails."""
+
+class PromptBudgetError(Exception):
+    """Raised when the question alone leaves no room for retrieved context in the input token budget."""
+
+class TokenBucket:
+    """
+    Async token bucket that queues callers until enough capacity is available.
+    
+    The bucket refills continuously at rate_per_minute and holds at most one
+    minute worth of tokens. Waiters are served in arrival order.
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.rate_per_minute = rate_per_minute
+        self.capacity = rate_per_minute
+        self._tokens = rate_per_minute
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated_at) * self.rate_per_minute / 60
         )
+        self._updated_at = now
+
+    async def acquire(self, amount: float = 1.0) -> float:
+        """
+        Take tokens from the bucket, waiting until they are available.
         
-        @validator('temperature')
-        def validate_temperature(cls, v):
-            if v < 0 or v > 1:
-                raise ValueError('Temperature must be between 0 and 1')
-            return v
+        Requests larger than the bucket are clamped to its capacity so they
+        cannot block forever.
+        
+        Args:
+            amount: Number of tokens to take
             
-        @validator('top_p')
-        def validate_top_p(cls, v):
-            if v < 0 or v > 1:
-                raise ValueError('Top-p must be between 0 and 1')
-            return v
+        Returns:
+            Seconds spent waiting
+        """
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        async with self._lock:
+            self._refill()
+            while self._tokens < amount:
+                delay = (amount - self._tokens) * 60 / self.rate_per_minute
+                await asyncio.sleep(delay)
+                waited += delay
+                self._refill()
+            self._tokens -= amount
+        return waited
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker.
+    
+    Each request that fails after exhausting its retries counts once. After
+    failure_threshold such requests in a row the circuit opens and calls fail
+    fast. Once reset_timeout seconds have passed, a single half-open probe is
+    let through; its success closes the circuit, its failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    def allow(self) -> bool:
+        """
+        Whether a request may be attempted now.
+        
+        While the circuit is open this admits at most one half-open probe at a
+        time; the probe must be finished with record_success, record_failure
+        or release.
+        """
+        if self.opened_at is None:
+            return True
+        if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+            return False
+        self.probing = True
+        return True
+
+    def record_success(self) -> None:
+        """Close the circuit after a successful request."""
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self) -> None:
+        """Count a failed request, opening the circuit at the threshold or after a failed probe."""
+        self.failures += 1
+        if self.probing or (self.failure_threshold and self.failures >= self.failure_threshold):
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    def release(self) -> None:
+        """Finish a probe whose outcome says nothing about service health, admitting the next one."""
+        self.probing = False
+
+class RetrievalCache:
+    """
+    LRU cache with TTL for knowledge base retrievalResults.
+    
+    Entries are keyed on knowledge base ID, normalized query text and number of
+    results. An optional SQLite file keeps entries across worker restarts; the
+    in-memory LRU is always consulted first.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, db_path: str = ""):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[float, str, List[Dict[str, Any]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS retrieval_cache ("
+                "key TEXT PRIMARY KEY, knowledge_base_id TEXT, expires_at REAL, results TEXT)"
+            )
+            self._db.commit()
+
+    @property
+    def persistent(self) -> bool:
+        """Whether entries are also stored on disk (lookups may then block on I/O)."""
+        return self._db is not None
+
+    @staticmethod
+    def make_key(
+        knowledge_base_id: str,
+        query: str,
+        number_of_results: int,
+        search_options: Optional[Dict[str, Any]] = None,
+    ) -> str:
+        """
+        Build the cache key for a retrieve call.
+        
+        Args:
+            knowledge_base_id: The knowledge base ID
+            query: The raw query text
+            number_of_results: The requested number of results
+            search_options: Search type and metadata filter of the request (optional)
+            
+        Returns:
+            The cache key
+        """
+        parts: List[Any] = [knowledge_base_id, normalize_query(query), number_of_results]
+        if search_options:
+            parts.append(search_options)
+        return json.dumps(parts, sort_keys=True)
+
+    def get(self, key: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        Look up cached retrievalResults.
+        
+        Args:
+            key: A key built by make_key
+            
+        Returns:
+            The cached results, or None on a miss or expired entry
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, _, results = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return results
+                del self._entries[key]
+            
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT knowledge_base_id, expires_at, results FROM retrieval_cache WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                if row is not None and row[1] > now:
+                    results = json.loads(row[2])
+                    self._store_memory(key, row[1], row[0], results)
+                    self.hits += 1
+                    return results
+            
+            self.misses += 1
+            return None
+
+    def put(self, key: str, knowledge_base_id: str, results: List[Dict[str, Any]]) -> None:
+        """
+        Store retrievalResults.
+        
+        Args:
+            key: A key built by make_key
+            knowledge_base_id: The knowledge base the results came from
+            results: The retrievalResults to cache
+        """
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._store_memory(key, expires_at, knowledge_base_id, results)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO retrieval_cache VALUES (?, ?, ?, ?)",
+                    (key, knowledge_base_id, expires_at, json.dumps(results, default=str)),
+                )
+                # Keep the file bounded to the same number of entries as memory
+                self._db.execute(
+                    "DELETE FROM retrieval_cache WHERE expires_at <= ? OR key NOT IN "
+                    "(SELECT key FROM retrieval_cache ORDER BY expires_at DESC LIMIT ?)",
+                    (time.time(), self.max_entries),
+                )
+                self._db.commit()
+
+    def _store_memory(
+        self, key: str, expires_at: float, knowledge_base_id: str, results: List[Dict[str, Any]]
+    ) -> None:
+        self._entries[key] = (expires_at, knowledge_base_id, results)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, knowledge_base_id: Optional[str] = None) -> int:
+        """
+        Drop cached entries, for example after a knowledge base sync.
+        
+        Args:
+            knowledge_base_id: Only drop entries for this knowledge base (all entries if None)
+            
+        Returns:
+            Number of in-memory entries removed
+        """
+        with self._lock:
+            if knowledge_base_id is None:
+                removed = len(self._entries)
+                self._entries.clear()
+            else:
+                stale = [k for k, v in self._entries.items() if v[1] == knowledge_base_id]
+                for key in stale:
+                    del self._entries[key]
+                removed = len(stale)
+            
+            if self._db is not None:
+                if knowledge_base_id is None:
+                    self._db.execute("DELETE FROM retrieval_cache")
+                else:
+                    self._db.execute(
+                        "DELETE FROM retrieval_cache WHERE knowledge_base_id = ?", (knowledge_base_id,)
+                    )
+                self._db.commit()
+            return removed
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get cache counters.
+        
+        Returns:
+            Dictionary with entries, hits, misses and hit_rate
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self) -> None:
+        """Close the SQLite backend, if any."""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+class ResponseCache:
+    """
+    LRU cache of generated answers bounded by a memory budget in bytes.
+    
+    Entries are keyed on a fingerprint of the model ID and the final request body,
+    so an answer is only reused for an identical prompt and sampling configuration.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(model_id: str, request_body: Dict[str, Any]) -> str:
+        """
+        Hash a model request into a cache key.
+        
+        Args:
+            model_id: The Bedrock model ID
+            request_body: The request body built by _get_model_request_body
+            
+        Returns:
+            Hex digest identifying the request
+        """
+        payload = json.dumps(request_body, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(f"{model_id}\n{payload}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _entry_size(key: str, text: str) -> int:
+        return len(key) + len(text.encode("utf-8"))
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Look up a cached answer.
+        
+        Args:
+            key: A key built by fingerprint
+            
+        Returns:
+            The cached answer, or None on a miss
+        """
+        with self._lock:
+            text = self._entries.get(key)
+            if text is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return text
+
+    def put(self, key: str, text: str) -> None:
+        """
+        Store an answer, evicting least recently used entries to stay within budget.
+        
+        Answers larger than the whole budget are not cached.
+        
+        Args:
+            key: A key built by fingerprint
+            text: The generated answer
+        """
+        size = self._entry_size(key, text)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size_bytes -= self._entry_size(key, previous)
+            self._entries[key] = text
+            self.size_bytes += size
+            while self.size_bytes > self.max_bytes:
+                old_key, old_text = self._entries.popitem(last=False)
+                self.size_bytes -= self._entry_size(old_key, old_text)
+
+    def clear(self) -> None:
+        """Drop all cached answers."""
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get cache counters.
+        
+        Returns:
+            Dictionary with entries, size_bytes, hits, misses and hit_rate
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "size_bytes": self.size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+class _CallFlight:
+    """One shared in-flight call and the number of requests waiting on it."""
+    
+    def __init__(self):
+        self.waiters = 0
+        self.task: Optional["asyncio.Future[Any]"] = None
+        self.progress = SharedProgress()
+
+class _StreamFlight:
+    """Chunks of one shared in-flight stream, kept so late joiners can replay them."""
+    
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Event()
+        self.subscribers = 0
+        self.task: Optional["asyncio.Future[None]"] = None
+        self.progress = SharedProgress()
+    
+    def notify(self) -> None:
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+class RequestCoalescer:
+    """
+    Single-flight deduplication of identical concurrent requests.
+    
+    The first request for a key starts the upstream work as a task; requests
+    with the same key that arrive while it runs wait for the same result
+    instead of calling Bedrock again. Streams buffer their chunks so a late
+    joiner first gets everything already emitted, then follows live. A call or
+    stream is cancelled once its last waiter goes away. Nothing is kept after a
+    flight finishes (that is what the response cache is for).
+    
+    The upstream work reports its status through the flight's SharedProgress,
+    so every waiting request gets the status updates and stage timings, not
+    only the one that started it.
+    """
+    
+    def __init__(self, on_saved: Optional[Callable[[str], None]] = None):
+        """
+        Args:
+            on_saved: Called with "complete" or "stream" whenever a request joins a flight
+        """
+        self._calls: Dict[str, _CallFlight] = {}
+        self._streams: Dict[str, _StreamFlight] = {}
+        self._on_saved = on_saved
+        self.saved = 0
+    
+    def _joined(self, kind: str) -> None:
+        self.saved += 1
+        if self._on_saved is not None:
+            self._on_saved(kind)
+    
+    async def run(
+        self,
+        key: str,
+        factory: Callable[["SharedProgress"], Awaitable[Any]],
+        tracker: Optional["StatusTracker"] = None,
+    ) -> Any:
+        """
+        Run factory() once for all concurrent callers with the same key.
+        
+        Args:
+            key: Identifies identical requests
+            factory: Starts the upstream work, reporting status to the progress it is given
+            tracker: The caller's status tracker, fed from the shared progress (optional)
+            
+        Returns:
+            The shared result (exceptions are shared too)
+        """
+        flight = self._calls.get(key)
+        if flight is None:
+            flight = _CallFlight()
+            self._calls[key] = flight
+            flight.task = asyncio.ensure_future(factory(flight.progress))
+            flight.task.add_done_callback(lambda done: self._forget(self._calls, key, flight))
+        else:
+            self._joined("complete")
+        
+        flight.waiters += 1
+        flight.progress.attach(tracker)
+        try:
+            # A caller that goes away must not cancel the work for the others
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.progress.detach(tracker)
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                self._forget(self._calls, key, flight)
+                flight.task.cancel()
+    
+    async def stream(
+        self,
+        key: str,
+        factory: Callable[["SharedProgress"], AsyncGenerator[str, None]],
+        tracker: Optional["StatusTracker"] = None,
+    ) -> AsyncGenerator[str, None]:
+        """
+        Share one upstream stream between all concurrent callers with the same key.
+        
+        Args:
+            key: Identifies identical requests
+            factory: Opens the upstream stream, reporting status to the progress it is given
+            tracker: The caller's status tracker, fed from the shared progress (optional)
+            
+        Yields:
+            All chunks of the shared stream, from the first one
+        """
+        flight = self._streams.get(key)
+        if flight is None:
+            flight = _StreamFlight()
+            self._streams[key] = flight
+            flight.task = asyncio.ensure_future(self._pump(key, flight, factory(flight.progress)))
+        else:
+            self._joined("stream")
+        
+        flight.subscribers += 1
+        flight.progress.attach(tracker)
+        index = 0
+        try:
+            while True:
+                while index < len(flight.chunks):
+                    index += 1
+                    yield flight.chunks[index - 1]
+                if flight.done:
+                    break
+                await flight.changed.wait()
+            if flight.error is not None:
+                raise flight.error
+        finally:
+            flight.progress.detach(tracker)
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                self._forget(self._streams, key, flight)
+                flight.task.cancel()
+    
+    @staticmethod
+    def _forget(flights: Dict[str, Any], key: str, flight: Any) -> None:
+        """Drop a flight so new requests for its key start a fresh one."""
+        if flights.get(key) is flight:
+            del flights[key]
+    
+    async def _pump(self, key: str, flight: _StreamFlight, source: AsyncGenerator[str, None]) -> None:
+        try:
+            async for chunk in source:
+                flight.chunks.append(chunk)
+                flight.notify()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            self._forget(self._streams, key, flight)
+            flight.notify()
+            await source.aclose()
+    
+    def stats(self) -> Dict[str, int]:
+        """
+        Get coalescing counters.
+        
+        Returns:
+            Dictionary with in_flight (shared calls and streams running) and
+            saved (upstream calls avoided by joining a flight)
+        """
+        return {"in_flight": len(self._calls) + len(self._streams), "saved": self.saved}
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+CHUNK_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+class PipeMetrics:
+    """
+    In-process metrics for the pipe: per-stage latency histograms, counters and
+    retrieved-chunk counts.
+    
+    Metrics can be scraped with render_prometheus() or pushed elsewhere by
+    setting callback, which is called as callback(name, value, labels) for
+    every recorded observation.
+    """
+
+    def __init__(self, prefix: str = "bedrock_kb", callback: Optional[Callable[[str, float, Dict[str, str]], None]] = None):
+        self.prefix = prefix
+        self.callback = callback
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], List[float]] = {}
+        self._histogram_buckets: Dict[str, Tuple[float, ...]] = {}
+        self._help: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, amount: float = 1.0, help_text: str = "", **labels: str) -> None:
+        """
+        Add to a counter.
+        
+        Args:
+            name: Counter name without prefix
+            amount: Amount to add
+            help_text: Description used in the Prometheus HELP line
+            **labels: Label values
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + amount
+            if help_text:
+                self._help.setdefault(name, help_text)
+        if self.callback is not None:
+            self.callback(name, amount, labels)
+
+    def observe(
+        self,
+        name: str,
+        value: float,
+        buckets: Tuple[float, ...] = DURATION_BUCKETS,
+        help_text: str = "",
+        **labels: str,
+    ) -> None:
+        """
+        Record a value in a histogram.
+        
+        Args:
+            name: Histogram name without prefix
+            value: Observed value
+            buckets: Upper bounds of the histogram buckets (fixed on first use)
+            help_text: Description used in the Prometheus HELP line
+            **labels: Label values
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            bounds = self._histogram_buckets.setdefault(name, buckets)
+            # Layout: one slot per bucket, then +Inf, then sum
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0.0] * (len(bounds) + 2)
+            series[bisect.bisect_left(bounds, value)] += 1
+            series[-1] += value
+            if help_text:
+                self._help.setdefault(name, help_text)
+        if self.callback is not None:
+            self.callback(name, value, labels)
+
+    @contextmanager
+    def time(self, stage: str):
+        """
+        Time a block of code as a pipeline stage.
+        
+        Args:
+            stage: Stage name (client_init, retrieve, prompt_build, invoke_model, parse, ...)
+        """
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(
+                "stage_duration_seconds",
+                time.perf_counter() - started_at,
+                help_text="Latency of each pipe stage in seconds",
+                stage=stage,
+            )
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Get a plain copy of all metrics.
+        
+        Returns:
+            Dictionary with 'counters' and 'histograms' keyed by name and labels
+        """
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "histograms": {key: list(series) for key, series in self._histograms.items()},
+            }
+
+    @staticmethod
+    def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(labels) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+        escaped = []
+        for key, value in pairs:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            escaped.append(f'{key}="{value}"')
+        return "{" + ",".join(escaped) + "}"
+
+    def render_prometheus(self) -> str:
+        """
+        Render all metrics in the Prometheus text exposition format.
+        
+        Returns:
+            The metrics text
+        """
+        lines: List[str] = []
+        with self._lock:
+            for name in sorted({key[0] for key in self._counters}):
+                full_name = f"{self.prefix}_{name}"
+                if name in self._help:
+                    lines.append(f"# HELP {full_name} {self._help[name]}")
+                lines.append(f"# TYPE {full_name} counter")
+                for (counter_name, labels), value in sorted(self._counters.items()):
+                    if counter_name == name:
+                        lines.append(f"{full_name}{self._format_labels(labels)} {value:g}")
+            
+            for name in sorted({key[0] for key in self._histograms}):
+                full_name = f"{self.prefix}_{name}"
+                bounds = self._histogram_buckets[name]
+                if name in self._help:
+                    lines.append(f"# HELP {full_name} {self._help[name]}")
+                lines.append(f"# TYPE {full_name} histogram")
+                for (histogram_name, labels), series in sorted(self._histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    cumulative = 0.0
+                    for bound, count in zip(bounds, series):
+                        cumulative += count
+                        lines.append(f"{full_name}_bucket{self._format_labels(labels, ('le', f'{bound:g}'))} {cumulative:g}")
+                    cumulative += series[len(bounds)]
+                    lines.append(f"{full_name}_bucket{self._format_labels(labels, ('le', '+Inf'))} {cumulative:g}")
+                    lines.append(f"{full_name}_sum{self._format_labels(labels)} {series[-1]:g}")
+                    lines.append(f"{full_name}_count{self._format_labels(labels)} {cumulative:g}")
+        return "\n".join(lines) + "\n"
+
+def format_history_entry(message: Dict[str, Any]) -> Optional[str]:
+    """
+    Render one chat message for the conversation history block.
+    
+    Args:
+        message: Message dictionary with 'role' and 'content' keys
+        
+    Returns:
+        The rendered entry, or None for roles that are not part of the history
+    """
+    role = message.get("role", "")
+    content = message.get("content", "")
+    if role == "user":
+        return f"User: {content}\n\n"
+    elif role == "assistant":
+        return f"Assistant: {content}\n\n"
+    return None
+
+def message_fingerprint(message: Dict[str, Any]) -> str:
+    """
+    Hash a chat message so a cached history prefix can be validated cheaply.
+    
+    Args:
+        message: Message dictionary with 'role' and 'content' keys
+        
+    Returns:
+        Hex digest of the message role and content
+    """
+    material = f"{message.get('role', '')}\n{message.get('content', '')}"
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+class ChatState:
+    """
+    Conversation state kept per OpenWebUI chat.
+    
+    Holds the rendered history entries not yet folded into the rolling summary,
+    the summary itself, and the Bedrock RetrieveAndGenerate session ID.
+    message_count and last_message_hash identify the prefix of the chat that
+    the entries cover, so each turn only has to render its new messages.
+    Entries are numbered from first_seq so the SQLite backend can write only
+    the entries added since the last save (up to saved_seq).
+    """
+
+    def __init__(self):
+        self.message_count = 0
+        self.last_message_hash = ""
+        self.entries: List[str] = []
+        self.entry_tokens: List[int] = []
+        self.entries_total_tokens = 0
+        self.summary = ""
+        self.summary_tokens = 0
+        self.bedrock_session_id: Optional[str] = None
+        # Bumped whenever the history is rebuilt, so stale summaries are discarded
+        self.generation = 0
+        self.summarizing = False
+        self.summary_failures = 0
+        self.summary_failed_at: Optional[float] = None
+        self.first_seq = 0
+        self.saved_seq = 0
+        self.saved_first_seq = 0
+
+    def summary_backoff(self) -> float:
+        """Seconds until summarization may be retried after recent failures (0 if it may run now)."""
+        if not self.summary_failures or self.summary_failed_at is None:
+            return 0.0
+        delay = min(SUMMARY_RETRY_MAX_SECONDS, SUMMARY_RETRY_BASE_SECONDS * 2 ** (self.summary_failures - 1))
+        return max(0.0, self.summary_failed_at + delay - time.monotonic())
+
+    def reset_history(self) -> None:
+        """Forget the cached history, summary and Bedrock session (e.g. after a message was edited)."""
+        self.message_count = 0
+        self.last_message_hash = ""
+        self.first_seq += len(self.entries)
+        self.entries = []
+        self.entry_tokens = []
+        self.entries_total_tokens = 0
+        self.summary = ""
+        self.summary_tokens = 0
+        self.bedrock_session_id = None
+        self.generation += 1
+
+    def append_entry(self, entry: str) -> None:
+        """Add a rendered history entry."""
+        tokens = estimate_tokens(entry)
+        self.entries.append(entry)
+        self.entry_tokens.append(tokens)
+        self.entries_total_tokens += tokens
+
+    def drop_oldest_entries(self, count: int) -> None:
+        """Remove the oldest rendered entries."""
+        count = min(count, len(self.entries))
+        self.first_seq += count
+        self.entries_total_tokens -= sum(self.entry_tokens[:count])
+        del self.entries[:count]
+        del self.entry_tokens[:count]
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Serialize everything but the entries (stored as rows of their own) for the SQLite backend."""
+        return {
+            "message_count": self.message_count,
+            "last_message_hash": self.last_message_hash,
+            "first_seq": self.first_seq,
+            "summary": self.summary,
+            "summary_tokens": self.summary_tokens,
+            "bedrock_session_id": self.bedrock_session_id,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ChatState":
+        """
+        Restore a state serialized with to_dict.
+        
+        Older rows kept the entries inline; those are restored too and are
+        written out as entry rows on the next save.
+        """
+        state = cls()
+        state.message_count = data.get("message_count", 0)
+        state.last_message_hash = data.get("last_message_hash", "")
+        state.first_seq = state.saved_seq = state.saved_first_seq = data.get("first_seq", 0)
+        state.entries = list(data.get("entries", []))
+        state.entry_tokens = list(data.get("entry_tokens", []))
+        state.entries_total_tokens = sum(state.entry_tokens)
+        state.summary = data.get("summary", "")
+        state.summary_tokens = data.get("summary_tokens", 0)
+        state.bedrock_session_id = data.get("bedrock_session_id")
+        return state
+
+class ChatStateStore:
+    """
+    LRU store of ChatState objects keyed by chat_id.
+    
+    An optional SQLite file keeps states across worker restarts; the in-memory
+    LRU is always consulted first. On disk each history entry is a row of its
+    own, so a save writes the chat's small state row plus only the entries
+    added since the previous save. Chats beyond max_entries are pruned every
+    prune_interval saves rather than on each one.
+    """
+
+    prune_interval = 100
+
+    def __init__(self, max_entries: int, db_path: str = ""):
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self._states: "OrderedDict[str, ChatState]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._writes = 0
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS chat_state ("
+                "chat_id TEXT PRIMARY KEY, updated_at REAL, state TEXT)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS chat_state_updated ON chat_state (updated_at)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS chat_entry ("
+                "chat_id TEXT, seq INTEGER, entry TEXT, tokens INTEGER, PRIMARY KEY (chat_id, seq))"
+            )
+            self._db.commit()
+
+    @property
+    def persistent(self) -> bool:
+        """Whether states are also stored on disk (lookups may then block on I/O)."""
+        return self._db is not None
+
+    def get(self, chat_id: str) -> Optional[ChatState]:
+        """
+        Look up the state of a chat.
+        
+        Args:
+            chat_id: The OpenWebUI chat ID
+            
+        Returns:
+            The chat state, or None if the chat is unknown
+        """
+        with self._lock:
+            state = self._states.get(chat_id)
+            if state is not None:
+                self._states.move_to_end(chat_id)
+                return state
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT state FROM chat_state WHERE chat_id = ?", (chat_id,)
+                ).fetchone()
+                if row is not None:
+                    data = json.loads(row[0])
+                    state = ChatState.from_dict(data)
+                    if "entries" not in data:
+                        for entry, tokens in self._db.execute(
+                            "SELECT entry, tokens FROM chat_entry WHERE chat_id = ? AND seq >= ? ORDER BY seq",
+                            (chat_id, state.first_seq),
+                        ):
+                            state.entries.append(entry)
+                            state.entry_tokens.append(tokens)
+                        state.entries_total_tokens = sum(state.entry_tokens)
+                        state.saved_seq = state.first_seq + len(state.entries)
+                    self._store_memory(chat_id, state)
+                    return state
+            return None
+
+    def put(self, chat_id: str, state: ChatState) -> None:
+        """
+        Store the state of a chat.
+        
+        Args:
+            chat_id: The OpenWebUI chat ID
+            state: The chat state
+        """
+        with self._lock:
+            self._store_memory(chat_id, state)
+            if self._db is not None:
+                end_seq = state.first_seq + len(state.entries)
+                start = max(state.saved_seq, state.first_seq) - state.first_seq
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO chat_entry VALUES (?, ?, ?, ?)",
+                    [
+                        (chat_id, state.first_seq + index, state.entries[index], state.entry_tokens[index])
+                        for index in range(start, len(state.entries))
+                    ],
+                )
+                if state.first_seq != state.saved_first_seq:
+                    # Entries were folded into the summary or the history was rebuilt
+                    self._db.execute(
+                        "DELETE FROM chat_entry WHERE chat_id = ? AND seq < ?", (chat_id, state.first_seq)
+                    )
+                self._db.execute(
+                    "INSERT OR REPLACE INTO chat_state VALUES (?, ?, ?)",
+                    (chat_id, time.time(), json.dumps(state.to_dict())),
+                )
+                self._writes += 1
+                if self._writes % self.prune_interval == 0:
+                    self._prune()
+                self._db.commit()
+                state.saved_seq = end_seq
+                state.saved_first_seq = state.first_seq
+
+    def _prune(self) -> None:
+        """Delete the least recently updated chats beyond max_entries, with their entries."""
+        self._db.execute(
+            "DELETE FROM chat_state WHERE chat_id NOT IN "
+            "(SELECT chat_id FROM chat_state ORDER BY updated_at DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+        self._db.execute("DELETE FROM chat_entry WHERE chat_id NOT IN (SELECT chat_id FROM chat_state)")
+
+    def _store_memory(self, chat_id: str, state: ChatState) -> None:
+        self._states[chat_id] = state
+        self._states.move_to_end(chat_id)
+        while len(self._states) > self.max_entries:
+            self._states.popitem(last=False)
+
+    def close(self) -> None:
+        """Close the SQLite backend, if any."""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+class ClientRegistry:
+    """
+    Thread-safe registry of boto3 clients shared by all pipe instances.
+    
+    Clients are keyed on service name, region, a fingerprint of the credentials
+    and the connection settings, so a valve change yields a new client while
+    unchanged settings reuse the existing one (and its connection pool).
+    """
+
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max_entries
+        self._sessions: "OrderedDict[Tuple[str, str], boto3.Session]" = OrderedDict()
+        self._clients: "OrderedDict[Tuple[Any, ...], Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def credentials_fingerprint(
+        aws_access_key_id: str, aws_secret_access_key: str, aws_session_token: str = ""
+    ) -> str:
+        """
+        Hash a credential set so it can be used in a key without keeping the secret around.
+        
+        Args:
+            aws_access_key_id: AWS access key ID
+            aws_secret_access_key: AWS secret access key
+            aws_session_token: AWS session token (optional)
+            
+        Returns:
+            Hex digest identifying the credential set
+        """
+        material = "\n".join([aws_access_key_id, aws_secret_access_key, aws_session_token])
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get_client(
+        self,
+        service_name: str,
+        region: str,
+        aws_access_key_id: str,
+        aws_secret_access_key: str,
+        aws_session_token: str = "",
+        config: Optional[Dict[str, Any]] = None,
+    ) -> Any:
+        """
+        Get a shared client, creating it on first use.
+        
+        Args:
+            service_name: The boto3 service name, e.g. 'bedrock-runtime'
+            region: AWS region
+            aws_access_key_id: AWS access key ID
+            aws_secret_access_key: AWS secret access key
+            aws_session_token: AWS session token (optional)
+            config: Keyword arguments for botocore.config.Config
+            
+        Returns:
+            The boto3 client
+        """
+        fingerprint = self.credentials_fingerprint(
+            aws_access_key_id, aws_secret_access_key, aws_session_token
+        )
+        config = config or {}
+        key = (service_name, region, fingerprint, json.dumps(config, sort_keys=True))
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+                return client
+            
+            session_key = (region, fingerprint)
+            session = self._sessions.get(session_key)
+            if session is None:
+                session_kwargs = {
+                    'aws_access_key_id': aws_access_key_id,
+                    'aws_secret_access_key': aws_secret_access_key,
+                    'region_name': region
+                }
+                if aws_session_token:
+                    session_kwargs['aws_session_token'] = aws_session_token
+                session = boto3.Session(**session_kwargs)
+                self._sessions[session_key] = session
+                while len(self._sessions) > self.max_entries:
+                    self._sessions.popitem(last=False)
+            
+            # Session.client is not thread-safe, so creation stays under the lock
+            client = session.client(service_name, config=Config(**config))
+            self._clients[key] = client
+            while len(self._clients) > self.max_entries:
+                self._clients.popitem(last=False)
+            return client
+
+    def clear(self) -> None:
+        """Forget all cached sessions and clients."""
+        with self._lock:
+            self._sessions.clear()
+            self._clients.clear()
+
+CLIENT_REGISTRY = ClientRegistry()
+
+SEARCH_TYPES = ("HYBRID", "SEMANTIC")
+
+FILTER_TOKEN_PATTERN = re.compile(
+    r"""\s*(?:(?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')"""
+    r"|(?P<number>-?\d+(?:\.\d+)?)(?![\w.])"
+    r"|(?P<symbol>>=|<=|!=|=|>|<|\(|\)|,)"
+    r"|(?P<variable>\$[A-Za-z_][\w.]*)"
+    r"|(?P<word>[A-Za-z_][\w.\-]*))"
+)
+
+FILTER_COMPARISONS = {
+    "=": "equals",
+    "!=": "notEquals",
+    ">": "greaterThan",
+    ">=": "greaterThanOrEquals",
+    "<": "lessThan",
+    "<=": "lessThanOrEquals",
+}
+
+FILTER_KEYWORDS = frozenset({"AND", "OR", "NOT", "IN", "STARTS", "WITH", "CONTAINS", "HAS", "TRUE", "FALSE"})
+
+class FilterVariable:
+    """A $name or $user.field placeholder in a compiled metadata filter, resolved per request."""
+    
+    def __init__(self, path: str):
+        self.path = path
+    
+    def resolve(self, variables: Dict[str, Any]) -> Any:
+        value: Any = variables
+        for part in self.path.split("."):
+            if not isinstance(value, dict) or value.get(part) in (None, ""):
+                raise ValueError(f"Metadata filter variable ${self.path} is not set")
+            value = value[part]
+        return value
+
+class MetadataFilter:
+    """
+    A metadata filter expression compiled to the Bedrock RetrievalFilter structure.
+    
+    Conditions compare a metadata key with a value and are combined with AND, OR
+    and parentheses:
+    
+        tenant = $user.tenant AND (doc_type IN ("faq", "guide") OR year >= 2023)
+    
+    Supported conditions are =, !=, >, >=, <, <=, IN (...), NOT IN (...),
+    STARTS WITH, CONTAINS (substring) and HAS (list membership). Values are
+    quoted strings, numbers, TRUE/FALSE or $variables; IN and NOT IN also take a
+    $variable holding a list. Variables are resolved per request by render().
+    
+    Use compile_metadata_filter() to share compiled filters across requests.
+    """
+    
+    def __init__(self, expression: str):
+        self.expression = expression
+        self._tokens = self._tokenize(expression)
+        self._position = 0
+        self.compiled = self._parse_or()
+        if self._position < len(self._tokens):
+            self._fail("end of expression")
+        del self._tokens
+    
+    def render(self, variables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Build the Bedrock filter for one request.
+        
+        Args:
+            variables: Values for $variables, e.g. {'user': {...}, 'tenant': 'acme'}
+            
+        Returns:
+            The filter for vectorSearchConfiguration
+            
+        Raises:
+            ValueError: If a variable used by the filter is not set
+        """
+        return self._render(self.compiled, variables or {})
+    
+    @classmethod
+    def _render(cls, node: Any, variables: Dict[str, Any]) -> Any:
+        if isinstance(node, FilterVariable):
+            return node.resolve(variables)
+        if isinstance(node, dict):
+            return {key: cls._render(value, variables) for key, value in node.items()}
+        if isinstance(node, list):
+            return [cls._render(value, variables) for value in node]
+        return node
+    
+    @staticmethod
+    def _tokenize(expression: str) -> List[Tuple[str, str, int]]:
+        tokens = []
+        position = 0
+        expression = expression.rstrip()
+        while position < len(expression):
+            match = FILTER_TOKEN_PATTERN.match(expression, position)
+            if match is None or not match.lastgroup:
+                position = len(expression) - len(expression[position:].lstrip())
+                raise ValueError(f"Invalid metadata filter at position {position}: {expression[position:position + 20]!r}")
+            tokens.append((match.lastgroup, match.group(match.lastgroup), match.start(match.lastgroup)))
+            position = match.end()
+        return tokens
+    
+    def _fail(self, expected: str) -> None:
+        if self._position < len(self._tokens):
+            _, text, position = self._tokens[self._position]
+            found = f"{text!r} at position {position}"
+        else:
+            found = "end of expression"
+        raise ValueError(f"Invalid metadata filter: expected {expected}, found {found}")
+    
+    def _peek_keyword(self, *keywords: str) -> bool:
+        if self._position + len(keywords) > len(self._tokens):
+            return False
+        for offset, keyword in enumerate(keywords):
+            kind, text, _ = self._tokens[self._position + offset]
+            if kind != "word" or text.upper() != keyword:
+                return False
+        return True
+    
+    def _accept_keyword(self, *keywords: str) -> bool:
+        if self._peek_keyword(*keywords):
+            self._position += len(keywords)
+            return True
+        return False
+    
+    def _accept_symbol(self, symbol: str) -> bool:
+        if self._position < len(self._tokens) and self._tokens[self._position][:2] == ("symbol", symbol):
+            self._position += 1
+            return True
+        return False
+    
+    def _combine(self, operator: str, parse: Callable[[], Dict[str, Any]], keyword: str) -> Dict[str, Any]:
+        items = [parse()]
+        while self._accept_keyword(keyword):
+            items.append(parse())
+        if len(items) == 1:
+            return items[0]
+        flattened: List[Dict[str, Any]] = []
+        for item in items:
+            flattened.extend(item[operator] if operator in item else [item])
+        return {operator: flattened}
+    
+    def _parse_or(self) -> Dict[str, Any]:
+        return self._combine("orAll", self._parse_and, "OR")
+    
+    def _parse_and(self) -> Dict[str, Any]:
+        return self._combine("andAll", self._parse_condition, "AND")
+    
+    def _parse_condition(self) -> Dict[str, Any]:
+        if self._accept_symbol("("):
+            node = self._parse_or()
+            if not self._accept_symbol(")"):
+                self._fail("')'")
+            return node
+        
+        if self._position >= len(self._tokens):
+            self._fail("a metadata key")
+        kind, key, _ = self._tokens[self._position]
+        if kind == "string":
+            key = self._parse_value()
+        elif kind != "word" or key.upper() in FILTER_KEYWORDS:
+            self._fail("a metadata key")
+        else:
+            self._position += 1
+        
+        if self._position < len(self._tokens) and self._tokens[self._position][1] in FILTER_COMPARISONS:
+            operator = FILTER_COMPARISONS[self._tokens[self._position][1]]
+            self._position += 1
+            return {operator: {'key': key, 'value': self._parse_value()}}
+        if self._accept_keyword("IN"):
+            return {'in': {'key': key, 'value': self._parse_list()}}
+        if self._accept_keyword("NOT", "IN"):
+            return {'notIn': {'key': key, 'value': self._parse_list()}}
+        if self._accept_keyword("STARTS", "WITH"):
+            return {'startsWith': {'key': key, 'value': self._parse_value()}}
+        if self._accept_keyword("CONTAINS"):
+            return {'stringContains': {'key': key, 'value': self._parse_value()}}
+        if self._accept_keyword("HAS"):
+            return {'listContains': {'key': key, 'value': self._parse_value()}}
+        self._fail("a comparison operator")
+    
+    def _parse_list(self) -> Any:
+        if self._position < len(self._tokens) and self._tokens[self._position][0] == "variable":
+            return self._parse_value()
+        if not self._accept_symbol("("):
+            self._fail("'(' or a $variable")
+        values = [self._parse_value()]
+        while self._accept_symbol(","):
+            values.append(self._parse_value())
+        if not self._accept_symbol(")"):
+            self._fail("')'")
+        return values
+    
+    def _parse_value(self) -> Any:
+        if self._position >= len(self._tokens):
+            self._fail("a value")
+        kind, text, _ = self._tokens[self._position]
+        if kind == "string":
+            value: Any = json.loads(text) if text[0] == '"' else text[1:-1].replace("\\'", "'")
+        elif kind == "number":
+            value = float(text) if "." in text else int(text)
+        elif kind == "variable":
+            value = FilterVariable(text[1:])
+        elif kind == "word" and text.upper() in ("TRUE", "FALSE"):
+            value = text.upper() == "TRUE"
+        else:
+            self._fail("a value")
+        self._position += 1
+        return value
+
+@functools.lru_cache(maxsize=128)
+def compile_metadata_filter(expression: str) -> MetadataFilter:
+    """
+    Compile a metadata filter expression, reusing earlier compilations.
+    
+    Args:
+        expression: The filter expression (see MetadataFilter)
+        
+    Returns:
+        The compiled filter
+        
+    Raises:
+        ValueError: If the expression is not valid
+    """
+    return MetadataFilter(expression)
+
+def result_source_uri(result: Dict[str, Any]) -> str:
+    """
+    Get the source location of a retrieval result.
+    
+    Args:
+        result: A single entry of retrievalResults
+        
+    Returns:
+        The S3 URI (or other location URL) of the source document, or 'Unknown'
+    """
+    location = result.get('location', {})
+    if 's3Location' in location:
+        return location['s3Location'].get('uri', 'Unknown')
+    for location_value in location.values():
+        if isinstance(location_value, dict) and location_value.get('url'):
+            return location_value['url']
+    return 'Unknown'
+
+def _passages_overlap(first: str, second: str, threshold: float = 0.8) -> bool:
+    """Whether two chunk texts are the same passage (containment or high word overlap)."""
+    if first in second or second in first:
+        return True
+    first_words, second_words = set(first.split()), set(second.split())
+    if not first_words or not second_words:
+        return False
+    return len(first_words & second_words) / len(first_words | second_words) >= threshold
+
+def fuse_retrieval_results(
+    result_lists: List[List[Dict[str, Any]]],
+    limit: Optional[int] = None,
+    rrf_k: int = 60,
+) -> List[Dict[str, Any]]:
+    """
+    Merge ranked retrievalResults from several retrieve calls.
+    
+    Lists are combined with reciprocal rank fusion, so scores from different
+    knowledge bases do not need to be comparable. Duplicate chunks (same source
+    URI and overlapping text) are collapsed into the best-ranked one.
+    
+    Args:
+        result_lists: One ranked list of retrievalResults per retrieve call
+        limit: Maximum number of results to return (all if None)
+        rrf_k: Reciprocal rank fusion constant
+        
+    Returns:
+        Fused results, best first; each is a copy with 'score' set to its fused score
+    """
+    fused: List[Tuple[float, Dict[str, Any]]] = []
+    kept_by_source: Dict[str, List[int]] = {}
+    for results in result_lists:
+        for rank, result in enumerate(results, 1):
+            text = " ".join(result.get('content', {}).get('text', '').split())
+            if not text:
+                continue
+            score = 1.0 / (rrf_k + rank)
+            source = result_source_uri(result)
+            for index in kept_by_source.get(source, []):
+                kept_text = fused[index][1]['content']['text']
+                if _passages_overlap(text, " ".join(kept_text.split())):
+                    fused[index] = (fused[index][0] + score, fused[index][1])
+                    break
+            else:
+                kept_by_source.setdefault(source, []).append(len(fused))
+                fused.append((score, result))
+    
+    fused.sort(key=lambda item: item[0], reverse=True)
+    if limit is not None:
+        fused = fused[:limit]
+    return [{**result, 'score': score} for score, result in fused]
+
+def _trim_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to roughly max_tokens, preferring a word boundary."""
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind(" ", 0, max_chars)
+    return text[:cut if cut > 0 else max_chars]
+
+def trim_history(conversation_history: str, max_tokens: int) -> str:
+    """
+    Keep the most recent part of a formatted conversation history within roughly max_tokens.
+    
+    Older lines are dropped first; the "Previous conversation" header is kept
+    while anything of the history remains.
+    
+    Args:
+        conversation_history: History as rendered for the prompt
+        max_tokens: Token budget for the history
+        
+    Returns:
+        The trimmed history (empty if nothing fits)
+    """
+    if estimate_tokens(conversation_history) <= max_tokens:
+        return conversation_history
+    header = "Previous conversation:\n\n"
+    body = conversation_history
+    if body.startswith(header):
+        body = body[len(header):]
+    max_chars = (max_tokens - estimate_tokens(header)) * 4
+    if max_chars <= 0:
+        return ""
+    tail = body[-max_chars:]
+    if len(body) > max_chars and body[-max_chars - 1] != "\n":
+        # Start at the next full line rather than mid-sentence
+        tail = tail[tail.find("\n") + 1:] if "\n" in tail else ""
+    tail = tail.lstrip("\n")
+    if not tail.strip():
+        return ""
+    return header + tail
+
+def build_context(
+    results: List[Dict[str, Any]],
+    token_budget: Optional[int] = None,
+    min_trimmed_tokens: int = 64,
+) -> Tuple[str, int, int]:
+    """
+    Assemble the [Document i] prompt context within a token budget.
+    
+    Passages are taken highest score first. The first passage that does not fit
+    is trimmed to the remaining budget (if at least min_trimmed_tokens remain, or
+    if it is the top passage) and all lower-scoring passages are dropped.
+    
+    Args:
+        results: Retrieved results, each with content.text and optionally score and location
+        token_budget: Maximum estimated tokens for the context (unbounded if None)
+        min_trimmed_tokens: Smallest useful size for a trimmed passage
+        
+    Returns:
+        Tuple of (context text, estimated tokens used, number of passages included)
+    """
+    ranked = sorted(
+        (result for result in results if result.get('content', {}).get('text')),
+        key=lambda result: result.get('score', 0.0),
+        reverse=True,
+    )
+    parts: List[str] = []
+    tokens_used = 0
+    for result in ranked:
+        source = ""
+        if 'location' in result:
+            source = f" (Source: {result_source_uri(result)})"
+        header = f"[Document {len(parts) + 1}{source}]\n"
+        content = result['content']['text']
+        passage_tokens = estimate_tokens(header) + estimate_tokens(content) + 1
+        if token_budget is not None and tokens_used + passage_tokens > token_budget:
+            remaining = token_budget - tokens_used - estimate_tokens(header) - 1
+            if remaining >= min_trimmed_tokens or (not parts and remaining > 0):
+                content = _trim_to_tokens(content, remaining)
+                parts.append(f"{header}{content}\n\n")
+                tokens_used += estimate_tokens(header) + estimate_tokens(content) + 1
+            break
+        parts.append(f"{header}{content}\n\n")
+        tokens_used += passage_tokens
+    return "".join(parts), tokens_used, len(parts)
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase word tokens for lexical scoring."""
+    return TOKEN_PATTERN.findall(text.casefold())
+
+class BM25Reranker:
+    """
+    Okapi BM25 over the candidate chunks themselves.
+    
+    Document frequencies come from the candidate set, so no index is needed.
+    Scores are divided by the best candidate's score, which puts them in [0, 1]
+    relative to the best match. Uses numpy for the scoring when it is installed.
+    """
+    
+    runs_in_executor = False
+    
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+    
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        """
+        Score candidate texts against a query.
+        
+        Args:
+            query: The search query
+            texts: Candidate chunk texts
+            
+        Returns:
+            One score in [0, 1] per text (all zero if no query term occurs)
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not texts:
+            return [0.0] * len(texts)
+        term_index = {term: i for i, term in enumerate(terms)}
+        lengths: List[int] = []
+        frequencies: List[List[int]] = []
+        for text in texts:
+            row = [0] * len(terms)
+            tokens = tokenize(text)
+            for token in tokens:
+                i = term_index.get(token)
+                if i is not None:
+                    row[i] += 1
+            lengths.append(len(tokens))
+            frequencies.append(row)
+        
+        if np is not None:
+            tf = np.asarray(frequencies, dtype=np.float64)
+            doc_len = np.asarray(lengths, dtype=np.float64)
+            df = (tf > 0).sum(axis=0)
+            idf = np.log1p((len(texts) - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * doc_len / max(doc_len.mean(), 1.0))
+            scores = (idf * tf * (self.k1 + 1) / (tf + norm[:, None])).sum(axis=1)
+            best = scores.max()
+            return (scores / best).tolist() if best > 0 else [0.0] * len(texts)
+        
+        average_length = max(sum(lengths) / len(lengths), 1.0)
+        idf = []
+        for i in range(len(terms)):
+            df = sum(1 for row in frequencies if row[i])
+            idf.append(math.log1p((len(texts) - df + 0.5) / (df + 0.5)))
+        scores = []
+        for row, length in zip(frequencies, lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / average_length)
+            scores.append(sum(w * tf * (self.k1 + 1) / (tf + norm) for w, tf in zip(idf, row) if tf))
+        best = max(scores)
+        return [s / best for s in scores] if best > 0 else [0.0] * len(texts)
+
+class CrossEncoderReranker:
+    """
+    Cross-encoder relevance model from sentence-transformers, run on CPU.
+    
+    Logits are mapped to [0, 1] with a sigmoid. Requires the optional
+    sentence-transformers package; the model is loaded on first use.
+    """
+    
+    runs_in_executor = True
+    
+    def __init__(self, model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"):
+        self.model_name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+    
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        """
+        Score candidate texts against a query.
+        
+        Args:
+            query: The search query
+            texts: Candidate chunk texts
+            
+        Returns:
+            One score in [0, 1] per text
+            
+        Raises:
+            ImportError: If sentence-transformers is not installed
+        """
+        if not texts:
+            return []
+        with self._lock:
+            if self._model is None:
+                from sentence_transformers import CrossEncoder
+                self._model = CrossEncoder(self.model_name, device="cpu")
+        logits = self._model.predict([(query, text) for text in texts])
+        return [1.0 / (1.0 + math.exp(-float(logit))) for logit in logits]
+
+RERANKERS: Dict[str, Callable[..., Any]] = {
+    "bm25": lambda model_name: BM25Reranker(),
+    "cross_encoder": lambda model_name: CrossEncoderReranker(model_name),
+}
+
+def rerank_results(
+    results: List[Dict[str, Any]],
+    scores: List[float],
+    limit: int,
+    threshold: float = 0.0,
+) -> List[Dict[str, Any]]:
+    """
+    Keep the best reranked results.
+    
+    Args:
+        results: Candidate retrievalResults
+        scores: Reranker score per candidate
+        limit: Maximum number of results to keep
+        threshold: Minimum score to keep a result
+        
+    Returns:
+        Kept results, best first; each is a copy with 'score' set to its reranker score
+    """
+    ranked = sorted(zip(scores, range(len(results))), key=lambda item: item[0], reverse=True)
+    return [{**results[i], 'score': score} for score, i in ranked[:limit] if score >= threshold]
+
+def batch_item_id(item: Union[str, Dict[str, Any]], index: int) -> str:
+    """Id of a raw batch input: its 'request_id' or 'id', else its position in the batch."""
+    item_id = (item.get("request_id") or item.get("id")) if isinstance(item, dict) else None
+    return str(item_id or f"item-{index}")
+
+def normalize_batch_item(item: Union[str, Dict[str, Any]], index: int) -> Dict[str, Any]:
+    """
+    Turn a batch input into an item with an id and OpenWebUI-style messages.
+    
+    Accepted shapes are a plain question string, or a dictionary with 'messages',
+    'question', or 'title'/'body' (as in requests.jsonl). The id is taken from
+    'request_id' or 'id' when present, otherwise from the position in the batch.
+    Per-request search overrides (search_type, metadata_filter, filter_variables)
+    are carried over.
+    
+    Args:
+        item: The raw batch input
+        index: Position of the item in the batch
+        
+    Returns:
+        Dictionary with 'id', 'messages' and any search overrides
+    """
+    item_id = batch_item_id(item, index)
+    if isinstance(item, str):
+        return {"id": item_id, "messages": [{"role": "user", "content": item}]}
+    overrides = {
+        field: item[field] for field in ("search_type", "metadata_filter", "filter_variables") if item.get(field)
+    }
+    if item.get("messages"):
+        return {"id": item_id, "messages": list(item["messages"]), **overrides}
+    if item.get("question"):
+        question = str(item["question"])
+    else:
+        question = "\n\n".join(str(item[field]) for field in ("title", "body") if item.get(field))
+    if not question:
+        raise ValueError(f"Batch item {item_id} has no question")
+    return {"id": item_id, "messages": [{"role": "user", "content": question}], **overrides}
+
+def read_jsonl(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Read a JSONL file lazily, skipping blank lines.
+    
+    Args:
+        path: Path to the JSONL file
+        
+    Yields:
+        One parsed object per line
+    """
+    with open(path, encoding="utf-8") as handle:
+        for line in handle:
+            if line.strip():
+                yield json.loads(line)
+
+def load_batch_checkpoint(path: str) -> set:
+    """
+    Get the ids of results already recorded in a batch checkpoint file.
+    
+    Args:
+        path: Path to the checkpoint JSONL file (may not exist yet)
+        
+    Returns:
+        Set of completed item ids
+    """
+    if not os.path.exists(path):
+        return set()
+    return {str(record["id"]) for record in read_jsonl(path) if "id" in record}
+
+def extract_event_info(event_emitter) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Extract chat_id and message_id from event emitter closure.
+    
+    Args:
+        event_emitter: The event emitter function with closure containing request info
+        
+    Returns:
+        Tuple containing chat_id and message_id, both can be None if not found
+    """
+    if not event_emitter or not event_emitter.__closure__:
+        return None, None
+    for cell in event_emitter.__closure__:
+        if isinstance(request_info := cell.cell_contents, dict):
+            chat_id = request_info.get("chat_id")
+            message_id = request_info.get("message_id")
+            return chat_id, message_id
+    return None, None
+
+class StatusTracker:
+    """
+    Status updates of one request, coalesced and flushed on a timer.
+    
+    update() never waits for the emitter: the latest in-progress status is sent
+    at most once per interval from a timer, and the final status is sent right
+    away (dropping any in-progress status still pending). Deliveries are
+    serialized so the final status always arrives last. Stage timings recorded
+    with record() are appended to the final status.
+    """
+    
+    def __init__(
+        self,
+        emitter: Callable[[Dict[str, Any]], Awaitable[None]],
+        interval: float,
+        enabled: bool = True,
+        on_done: Optional[Callable[[], None]] = None,
+    ):
+        """
+        Args:
+            emitter: The request's OpenWebUI event emitter
+            interval: Minimum time in seconds between in-progress updates
+            enabled: Whether status updates are sent at all
+            on_done: Called once the final status has been queued
+        """
+        self.emitter = emitter
+        self.interval = interval
+        self.enabled = enabled
+        self.done = False
+        self.started_at = time.perf_counter()
+        self.timings: Dict[str, float] = {}
+        self._on_done = on_done
+        self._pending: Optional[Dict[str, Any]] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._last_sent = float("-inf")
+        self._lock = asyncio.Lock()
+        self._deliveries: set = set()
+    
+    def record(self, stage: str, seconds: float) -> None:
+        """
+        Record how long a stage of this request took.
+        
+        Args:
+            stage: Stage name (retrieval, generation, first_token, ...)
+            seconds: Duration in seconds
+        """
+        self.timings[stage] = seconds * 1000
+    
+    def summary(self) -> str:
+        """Stage timings and total time so far, e.g. 'retrieval 120 ms, total 950 ms'."""
+        timings = dict(self.timings, total=(time.perf_counter() - self.started_at) * 1000)
+        return ", ".join(f"{stage.replace('_', ' ')} {ms:.0f} ms" for stage, ms in timings.items())
+    
+    def update(self, level: str, message: str, done: bool = False) -> None:
+        """
+        Queue a status update.
+        
+        Args:
+            level: Status level (info, warning, error)
+            message: Status message to display
+            done: Whether this is the final status update
+        """
+        if self.done:
+            return
+        if done:
+            self.done = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._pending = None
+            if self.enabled:
+                if level == "info":
+                    message = f"{message} ({self.summary()})"
+                self._send(self._event(level, message, True))
+            if self._on_done is not None:
+                self._on_done()
+            return
+        
+        if not self.enabled:
+            return
+        self._pending = self._event(level, message, False)
+        if self._timer is None:
+            delay = max(0.0, self._last_sent + self.interval - time.monotonic())
+            self._timer = asyncio.get_running_loop().call_later(delay, self._flush)
+    
+    @staticmethod
+    def _event(level: str, message: str, done: bool) -> Dict[str, Any]:
+        return {
+            "type": "status",
+            "data": {
+                "status": "complete" if done else "in_progress",
+                "level": level,
+                "description": message,
+                "done": done,
+            },
+        }
+    
+    def _flush(self) -> None:
+        self._timer = None
+        if self._pending is not None:
+            event, self._pending = self._pending, None
+            self._last_sent = time.monotonic()
+            self._send(event)
+    
+    def _send(self, event: Dict[str, Any]) -> None:
+        delivery = asyncio.ensure_future(self._deliver(event))
+        self._deliveries.add(delivery)
+        delivery.add_done_callback(self._deliveries.discard)
+    
+    async def _deliver(self, event: Dict[str, Any]) -> None:
+        async with self._lock:
+            try:
+                await self.emitter(event)
+            except Exception as e:
+                logger.debug("Status update failed: %s", e)
+
+class SharedProgress:
+    """
+    Status of work done on behalf of one or more requests.
+    
+    Stage timings and in-progress updates are forwarded to the status tracker
+    of every attached request. They are also kept, so a request that attaches
+    late (a coalesced joiner) first gets what it missed.
+    """
+    
+    def __init__(self):
+        self.timings: Dict[str, float] = {}
+        self.status: Optional[Tuple[str, str]] = None
+        self._trackers: List[StatusTracker] = []
+    
+    def attach(self, tracker: Optional[StatusTracker]) -> None:
+        """Forward progress to a request's tracker, replaying what it missed."""
+        if tracker is None:
+            return
+        self._trackers.append(tracker)
+        for stage, seconds in self.timings.items():
+            tracker.record(stage, seconds)
+        if self.status is not None:
+            tracker.update(*self.status)
+    
+    def detach(self, tracker: Optional[StatusTracker]) -> None:
+        """Stop forwarding progress to a request's tracker."""
+        if tracker in self._trackers:
+            self._trackers.remove(tracker)
+    
+    def record(self, stage: str, started_at: float) -> None:
+        """
+        Record a finished stage on every attached tracker.
+        
+        Args:
+            stage: Stage name (retrieval, generation, ...)
+            started_at: time.perf_counter() value taken when the stage started
+        """
+        seconds = time.perf_counter() - started_at
+        self.timings[stage] = seconds
+        for tracker in self._trackers:
+            tracker.record(stage, seconds)
+    
+    def update(self, level: str, message: str) -> None:
+        """
+        Send an in-progress status to every attached tracker.
+        
+        Args:
+            level: Status level (info, warning, error)
+            message: Status message to display
+        """
+        self.status = (level, message)
+        for tracker in self._trackers:
+            tracker.update(level, message)
+
+class Pipe:
+    class Valves(BaseModel):
+        aws_access_key_id: str = Field(
+            default="", description="AWS Access Key ID"
+        )
+        aws_secret_access_key: str = Field(
+            default="", description="AWS Secret Access Key"
+        )
+        aws_session_token: str = Field(
+            default="", description="AWS Session Token (optional, for temporary credentials)"
+        )
+        aws_region: str = Field(
+            default="eu-west-1", description="AWS Region"
+        )
+        knowledge_base_id: Union[str, List[str]] = Field(
+            default="", description="AWS Bedrock Knowledge Base ID, or several IDs (list or comma-separated) to query in parallel"
+        )
+        model_id: str = Field(
+            default="anthropic.claude-3-sonnet-20240229-v1:0",
+            description="Model ID to use for retrieval"
+        )
+        max_tokens: int = Field(
+            default=4096, description="Maximum number of tokens in the response"
+        )
+        temperature: float = Field(
+            default=0.7, description="Temperature for model generation"
+        )
+        top_p: float = Field(
+            default=0.9, description="Top-p sampling parameter"
+        )
+        number_of_results: int = Field(
+            default=5, description="Number of knowledge base results to retrieve"
+        )
+        use_conversation_history: bool = Field(
+            default=True, description="Whether to include conversation history for context"
+        )
+        max_history_messages: int = Field(
+            default=10, description="Maximum number of previous messages to include in history"
+        )
+        max_input_tokens: int = Field(
+            default=8000, description="Input token budget for the prompt (history, retrieved passages and question)"
+        )
+        max_history_tokens: int = Field(
+            default=2000, description="Part of the input token budget that conversation history may use"
+        )
+        chat_state_cache_size: int = Field(
+            default=1024, description="Maximum number of chats whose history state is kept"
+        )
+        chat_state_path: str = Field(
+            default="", description="Optional SQLite file so chat state survives restarts (empty for memory only)"
+        )
+        enable_history_summarization: bool = Field(
+            default=False, description="Fold older turns into a rolling summary produced by summary_model_id"
+        )
+        summary_model_id: str = Field(
+            default="anthropic.claude-3-haiku-20240307-v1:0",
+            description="Cheap model used to summarize older conversation turns"
+        )
+        summary_threshold_tokens: int = Field(
+            default=1500, description="History size in tokens above which older turns are summarized"
+        )
+        summary_max_tokens: int = Field(
+            default=300, description="Maximum number of tokens in a rolling history summary"
+        )
+        enable_query_rewrite: bool = Field(
+            default=False, description="Rewrite follow-up questions into standalone search queries before retrieval"
+        )
+        query_rewrite_model_id: str = Field(
+            default="anthropic.claude-3-haiku-20240307-v1:0",
+            description="Small, fast model used to rewrite search queries"
+        )
+        query_rewrite_temperature: float = Field(
+            default=0.0,
+            description="Temperature for query rewriting (0 keeps rewrites, and the caches keyed on them, stable)"
+        )
+        query_variants: int = Field(
+            default=1, description="Number of search queries to retrieve with and fuse (1 for the rewrite only)"
+        )
+        search_type: str = Field(
+            default="", description="overrideSearchType for retrieval: HYBRID, SEMANTIC, or empty for the knowledge base default"
+        )
+        metadata_filter: str = Field(
+            default="",
+            description=(
+                "Metadata filter applied to every retrieval, e.g. "
+                "tenant = $user.tenant AND doc_type IN (\"faq\", \"guide\") (empty for none)"
+            ),
+        )
+        enable_reranking: bool = Field(
+            default=False, description="Over-fetch candidates and keep the best number_of_results after local reranking"
+        )
+        reranker: str = Field(
+            default="bm25", description="Reranker to score candidates with: bm25 or cross_encoder (needs sentence-transformers)"
+        )
+        rerank_model_id: str = Field(
+            default="cross-encoder/ms-marco-MiniLM-L-6-v2", description="Model used by the cross_encoder reranker"
+        )
+        rerank_overfetch_factor: int = Field(
+            default=4, description="Candidates retrieved per kept result when reranking (capped at 100)"
+        )
+        rerank_score_threshold: float = Field(
+            default=0.0, description="Drop reranked results scoring below this value (0 to 1; BM25 is relative to the best match)"
+        )
+        emit_interval: float = Field(
+            default=2.0, description="Interval in seconds between status emissions"
+        )
+        enable_status_indicator: bool = Field(
+            default=True, description="Enable or disable status indicator emissions"
+        )
+        enable_request_coalescing: bool = Field(
+            default=True, description="Share one Bedrock call between identical questions asked at the same time"
+        )
+        enable_prompt_caching: bool = Field(
+            default=False,
+            description=(
+                "Mark the system instructions, retrieved context and history as Bedrock prompt cache "
+                "checkpoints (only for models that support prompt caching)"
+            ),
+        )
+        max_concurrent_requests: int = Field(
+            default=16, description="Maximum number of AWS Bedrock calls run concurrently in the worker thread pool"
+        )
+        max_pool_connections: int = Field(
+            default=50, description="Maximum number of HTTP connections kept per AWS client"
+        )
+        connect_timeout: float = Field(
+            default=10.0, description="Timeout in seconds for establishing a connection to AWS"
+        )
+        read_timeout: float = Field(
+            default=300.0, description="Timeout in seconds for reading a response from AWS"
+        )
+        tcp_keepalive: bool = Field(
+            default=True, description="Enable TCP keep-alive on AWS connections"
+        )
+        max_retries: int = Field(
+            default=4, description="Maximum retries for throttled or unavailable AWS Bedrock calls"
+        )
+        retry_base_delay: float = Field(
+            default=0.5, description="Base delay in seconds for exponential backoff between retries"
+        )
+        retry_max_delay: float = Field(
+            default=20.0, description="Maximum delay in seconds between retries"
+        )
+        requests_per_minute: int = Field(
+            default=0, description="Client-side limit on model invocations per minute (0 to disable)"
+        )
+        tokens_per_minute: int = Field(
+            default=0, description="Client-side limit on model tokens per minute, input plus max_tokens (0 to disable)"
+        )
+        circuit_breaker_threshold: int = Field(
+            default=5, description="Consecutive requests failing with unavailable errors after retries before failing fast (0 to disable)"
+        )
+        circuit_breaker_reset_seconds: float = Field(
+            default=30.0, description="Seconds to fail fast before trying AWS Bedrock again"
+        )
+        enable_streaming: bool = Field(
+            default=False, description="Stream the response token by token instead of waiting for the full answer"
+        )
+        generation_mode: str = Field(
+            default="retrieve_then_generate",
+            description="'retrieve_then_generate' (retrieve + invoke_model) or 'retrieve_and_generate' (one Bedrock RetrieveAndGenerate call with server-side sessions)"
+        )
+        enable_retrieval_cache: bool = Field(
+            default=True, description="Cache knowledge base retrieval results for repeated questions"
+        )
+        retrieval_cache_size: int = Field(
+            default=256, description="Maximum number of cached retrieval results"
+        )
+        retrieval_cache_ttl: float = Field(
+            default=300.0, description="Time in seconds before a cached retrieval result expires"
+        )
+        retrieval_cache_path: str = Field(
+            default="", description="Optional SQLite file so the retrieval cache survives restarts (empty for memory only)"
+        )
+        enable_response_cache: bool = Field(
+            default=False, description="Reuse generated answers for identical model requests"
+        )
+        response_cache_max_bytes: int = Field(
+            default=16 * 1024 * 1024, description="Memory budget in bytes for cached answers"
+        )
+        response_cache_max_temperature: float = Field(
+            default=0.3, description="Only cache and reuse answers when temperature is at or below this value"
+        )
+        
+        @validator('temperature', 'query_rewrite_temperature')
+        def validate_temperature(cls, v):
+            if v < 0 or v > 1:
+                raise ValueError('Temperature must be between 0 and 1')
+            return v
+            
+        @validator('top_p')
+        def validate_top_p(cls, v):
+            if v < 0 or v > 1:
+                raise ValueError('Top-p must be between 0 and 1')
+            return v
+            
+        @validator('number_of_results')
+        def validate_number_of_results(cls, v):
+            if v < 1 or v > 100:
+                raise ValueError('Number of results must be between 1 and 100')
+            return v
+
+        @validator('query_variants')
+        def validate_query_variants(cls, v):
+            if v < 1 or v > 5:
+                raise ValueError('Query variants must be between 1 and 5')
+            return v
+
+        @validator('search_type')
+        def validate_search_type(cls, v):
+            if v and v.upper() not in SEARCH_TYPES:
+                raise ValueError(f"Search type must be empty or one of: {', '.join(SEARCH_TYPES)}")
+            return v.upper()
+
+        @validator('metadata_filter')
+        def validate_metadata_filter(cls, v):
+            if v.strip():
+                compile_metadata_filter(v.strip())
+            return v.strip()
+
+        @validator('reranker')
+        def validate_reranker(cls, v):
+            if v not in RERANKERS:
+                raise ValueError(f"Reranker must be one of: {', '.join(RERANKERS)}")
+            return v
+
+        @validator('rerank_overfetch_factor')
+        def validate_rerank_overfetch_factor(cls, v):
+            if v < 1:
+                raise ValueError('Rerank over-fetch factor must be at least 1')
+            return v
+
+        @validator('rerank_score_threshold')
+        def validate_rerank_score_threshold(cls, v):
+            if v < 0 or v > 1:
+                raise ValueError('Rerank score threshold must be between 0 and 1')
+            return v
+
+        @validator('retrieval_cache_size')
+        def validate_retrieval_cache_size(cls, v):
+            if v < 1:
+                raise ValueError('Retrieval cache size must be at least 1')
+            return v
+
+        @validator('response_cache_max_bytes')
+        def validate_response_cache_max_bytes(cls, v):
+            if v < 1:
+                raise ValueError('Response cache budget must be at least 1 byte')
+            return v
+
+        @validator('max_input_tokens', 'max_history_tokens', 'chat_state_cache_size', 'summary_threshold_tokens', 'summary_max_tokens')
+        def validate_token_budget(cls, v):
+            if v < 1:
+                raise ValueError('Token budgets must be at least 1')
+            return v
+
+        @validator('generation_mode')
+        def validate_generation_mode(cls, v):
+            if v not in GENERATION_MODES:
+                raise ValueError(f"Generation mode must be one of: {', '.join(GENERATION_MODES)}")
+            return v
+
+        @validator('max_concurrent_requests')
+        def validate_max_concurrent_requests(cls, v):
+            if v < 1:
+                raise ValueError('Max concurrent requests must be at least 1')
+            return v
+
+        @validator('max_retries', 'requests_per_minute', 'tokens_per_minute', 'circuit_breaker_threshold')
+        def validate_non_negative(cls, v):
+            if v < 0:
+                raise ValueError('Value must not be negative')
+            return v
+
+        @validator('max_pool_connections')
+        def validate_max_pool_connections(cls, v):
+            if v < 1:
+                raise ValueError('Max pool connections must be at least 1')
+            return v
+
+    def __init__(self):
+        """Initialize the AWS Bedrock Knowledge Base pipe"""
+        self.type = "pipe"
+        self.id = "aws_bedrock_kb"
+        self.name = "AWS Bedrock Knowledge Base"
+        self.valves = self.Valves()
+        self.bedrock_client = None
+        self.bedrock_agent_client = None
+        self._clients_key: Optional[Tuple[Any, ...]] = None
+        self._pinned_clients: Dict[str, Any] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_workers = 0
+        self._retrieval_cache: Optional[RetrievalCache] = None
+        self._response_cache: Optional[ResponseCache] = None
+        self._request_limiter: Optional[TokenBucket] = None
+        self._token_limiter: Optional[TokenBucket] = None
+        self._circuit_breaker: Optional[CircuitBreaker] = None
+        self.metrics = PipeMetrics()
+        self._chat_state_store: Optional[ChatStateStore] = None
+        self._background_tasks: set = set()
+        self._reranker: Optional[Any] = None
+        self._reranker_key: Optional[Tuple[str, str]] = None
+        self._coalescer = RequestCoalescer(on_saved=self._record_coalesced)
+        self._status_trackers: Dict[Any, StatusTracker] = {}
+
+    def _client_config(self) -> Dict[str, Any]:
+        """
+        Build botocore Config arguments from the connection valves.
+        
+        Returns:
+            Keyword arguments for botocore.config.Config
+        """
+        return {
+            'max_pool_connections': self.valves.max_pool_connections,
+            'connect_timeout': self.valves.connect_timeout,
+            'read_timeout': self.valves.read_timeout,
+            'tcp_keepalive': self.valves.tcp_keepalive,
+            # Retries are handled by _call_bedrock so botocore must not retry on its own
+            'retries': {'total_max_attempts': 1, 'mode': 'standard'},
+        }
+
+    def _client_settings_key(self) -> Tuple[Any, ...]:
+        """
+        Get a key describing the valves that affect client construction.
+        
+        Returns:
+            Tuple that changes whenever the clients need to be rebuilt
+        """
+        return (
+            self.valves.aws_region,
+            ClientRegistry.credentials_fingerprint(
+                self.valves.aws_access_key_id,
+                self.valves.aws_secret_access_key,
+                self.valves.aws_session_token,
+            ),
+            json.dumps(self._client_config(), sort_keys=True),
+        )
+
+    def _get_client(self, service_name: str) -> Any:
+        """
+        Get a client for an AWS service from the shared registry.
+        
+        Clients pinned with set_client take precedence over the registry.
+        
+        Args:
+            service_name: The boto3 service name
+            
+        Returns:
+            The boto3 client
+        """
+        if service_name in self._pinned_clients:
+            return self._pinned_clients[service_name]
+        return CLIENT_REGISTRY.get_client(
+            service_name,
+            self.valves.aws_region,
+            self.valves.aws_access_key_id,
+            self.valves.aws_secret_access_key,
+            self.valves.aws_session_token,
+            self._client_config(),
+        )
+
+    def set_client(self, service_name: str, client: Any) -> None:
+        """
+        Pin a client for an AWS service, bypassing the shared registry.
+        
+        This is meant for stubbed or fake clients, e.g. botocore.stub.Stubber.
+        
+        Args:
+            service_name: The boto3 service name, e.g. 'bedrock-runtime'
+            client: The client to use for that service
+        """
+        self._pinned_clients[service_name] = client
+        self._clients_key = None
+
+    def _initialize_clients(self) -> None:
+        """
+        Initialize AWS Bedrock clients with credentials.
+        
+        This method fetches boto3 clients for Bedrock Runtime and Bedrock Agent Runtime
+        from the shared client registry, so sessions and connection pools are reused
+        across pipe instances. Clients are fetched again whenever the region,
+        credentials or connection valves change. It is safe to call from several
+        worker threads at once.
+        
+        Raises:
+            Exception: If client initialization fails
+        """
+        settings_key = self._client_settings_key()
+        if self._clients_key == settings_key:
+            return
+        
+        try:
+            self.bedrock_client = self._get_client('bedrock-runtime')
+            self.bedrock_agent_client = self._get_client('bedrock-agent-runtime')
+            self._clients_key = settings_key
+        except Exception as e:
+            self._clients_key = None
+            raise Exception(f"Failed to initialize AWS clients: {str(e)}")
+
+    async def _ensure_clients(self) -> None:
+        """
+        Make sure the clients match the current valves without blocking the event loop.
+        
+        The check is a cheap key comparison; only actual client creation runs in
+        the thread pool.
+        """
+        if self._clients_key != self._client_settings_key():
+            with self.metrics.time("client_init"):
+                await self._run_blocking(self._initialize_clients)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """
+        Get the thread pool used to run blocking boto3 calls.
+        
+        The pool is sized by the max_concurrent_requests valve and is rebuilt
+        when that valve changes. Calls beyond the pool size are queued.
+        
+        Returns:
+            The thread pool executor for AWS Bedrock calls
+        """
+        workers = self.valves.max_concurrent_requests
+        if self._executor is None or self._executor_workers != workers:
+            previous = self._executor
+            self._executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="bedrock-kb"
+            )
+            self._executor_workers = workers
+            if previous is not None:
+                # Let in-flight calls finish on the old pool without blocking the event loop
+                previous.shutdown(wait=False)
+        return self._executor
+
+    async def _run_blocking(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        Run a blocking function in the Bedrock thread pool without blocking the event loop.
+        
+        If the awaiting task is cancelled (for example because the user aborted the
+        chat), the CancelledError is raised here immediately and the result of the
+        worker thread is discarded.
+        
+        Args:
+            func: The blocking callable to run
+            *args: Positional arguments for the callable
+            **kwargs: Keyword arguments for the callable
+            
+        Returns:
+            The return value of the callable
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._get_executor(), functools.partial(func, *args, **kwargs)
+        )
+
+    def _get_rate_limiters(self) -> Tuple[Optional[TokenBucket], Optional[TokenBucket]]:
+        """
+        Get the request and token rate limiters, rebuilding them when their valves change.
+        
+        Returns:
+            Tuple of (requests-per-minute bucket, tokens-per-minute bucket); either is
+            None when its limit is disabled
+        """
+        rpm = self.valves.requests_per_minute
+        tpm = self.valves.tokens_per_minute
+        if not rpm:
+            self._request_limiter = None
+        elif self._request_limiter is None or self._request_limiter.rate_per_minute != rpm:
+            self._request_limiter = TokenBucket(rpm)
+        if not tpm:
+            self._token_limiter = None
+        elif self._token_limiter is None or self._token_limiter.rate_per_minute != tpm:
+            self._token_limiter = TokenBucket(tpm)
+        return self._request_limiter, self._token_limiter
+
+    def _get_circuit_breaker(self) -> CircuitBreaker:
+        """
+        Get the circuit breaker, rebuilding it when its valves change.
+        
+        Returns:
+            The circuit breaker shared by all calls of this pipe
+        """
+        breaker = self._circuit_breaker
+        if (
+            breaker is None
+            or breaker.failure_threshold != self.valves.circuit_breaker_threshold
+            or breaker.reset_timeout != self.valves.circuit_breaker_reset_seconds
+        ):
+            breaker = CircuitBreaker(
+                self.valves.circuit_breaker_threshold, self.valves.circuit_breaker_reset_seconds
+            )
+            self._circuit_breaker = breaker
+        return breaker
+
+    async def _call_bedrock(
+        self,
+        func: Callable[..., Any],
+        *args: Any,
+        model_tokens: Optional[int] = None,
+        **kwargs: Any,
+    ) -> Any:
+        """
+        Call AWS Bedrock through the thread pool with rate limiting, retries and a circuit breaker.
+        
+        Throttling and service-unavailable errors are retried with exponential backoff
+        and full jitter. Model invocations (model_tokens set) first wait for the
+        requests-per-minute and tokens-per-minute buckets, so bursts are queued
+        instead of being throttled by Bedrock. The circuit breaker sees one outcome
+        per call, after its retries, and ignores throttling.
+        
+        Args:
+            func: The blocking boto3 call to make
+            *args: Positional arguments for the call
+            model_tokens: Estimated tokens for a model invocation, or None for calls
+                that do not count against the model quotas
+            **kwargs: Keyword arguments for the call
+            
+        Returns:
+            The return value of the call
+            
+        Raises:
+            CircuitOpenError: If the circuit breaker is open
+            ClientError: For non-retryable errors, or when retries are exhausted
+        """
+        breaker = self._get_circuit_breaker()
+        probe = breaker.opened_at is not None
+        if not breaker.allow():
+            self.metrics.increment("errors_total", help_text="AWS Bedrock errors by code", code="CircuitOpen")
+            raise CircuitOpenError(
+                "AWS Bedrock is temporarily unavailable after repeated throttling or service errors. "
+                "Please try again shortly."
+            )
+        
+        max_retries = self.valves.max_retries
+        attempt = 0
+        healthy = False
+        try:
+            while True:
+                if model_tokens is not None:
+                    request_limiter, token_limiter = self._get_rate_limiters()
+                    if request_limiter is not None:
+                        await request_limiter.acquire(1)
+                    if token_limiter is not None:
+                        await token_limiter.acquire(model_tokens)
+                
+                try:
+                    result = await self._run_blocking(func, *args, **kwargs)
+                except ClientError as e:
+                    code = e.response.get('Error', {}).get('Code', 'Unknown')
+                    self.metrics.increment("errors_total", help_text="AWS Bedrock errors by code", code=code)
+                    if code not in RETRYABLE_ERROR_CODES:
+                        raise
+                    if attempt >= max_retries:
+                        if code not in THROTTLING_ERROR_CODES:
+                            breaker.record_failure()
+                        raise
+                except (ConnectTimeoutError, EndpointConnectionError) as e:
+                    self.metrics.increment(
+                        "errors_total", help_text="AWS Bedrock errors by code", code=type(e).__name__
+                    )
+                    if attempt >= max_retries:
+                        breaker.record_failure()
+                        raise
+                else:
+                    healthy = True
+                    breaker.record_success()
+                    return result
+                
+                self.metrics.increment("retries_total", help_text="Retried AWS Bedrock calls")
+                delay = min(self.valves.retry_max_delay, self.valves.retry_base_delay * (2 ** attempt))
+                await asyncio.sleep(random.uniform(0, delay))
+                attempt += 1
+        finally:
+            if probe and not healthy:
+                # Throttled, rejected or cancelled probes leave the circuit as it was
+                breaker.release()
+
+    def _invoke_model_sync(
+        self, request_body: Dict[str, Any], model_id: Optional[str] = None
+    ) -> Tuple[Dict[str, Any], Dict[str, int]]:
+        """
+        Invoke the model (or call Converse) and read the full response.
+        
+        This runs in a worker thread because both the request and the body read block.
+        
+        Args:
+            request_body: The model-specific request body
+            model_id: Model to invoke (defaults to the model_id valve)
+            
+        Returns:
+            Tuple of (parsed JSON response body, token usage with input_tokens,
+            output_tokens, cache_read_tokens and cache_write_tokens)
+        """
+        model_id = model_id or self.valves.model_id
+        if self._get_model_codec(model_id).uses_converse:
+            response = self.bedrock_client.converse(modelId=model_id, **request_body)
+            return response, ConverseCodec.response_usage(response)
+        
+        model_response = self.bedrock_client.invoke_model(
+            modelId=model_id,
+            body=json.dumps(request_body)
+        )
+        headers = model_response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+        usage = {
+            'input_tokens': int(headers.get('x-amzn-bedrock-input-token-count', 0)),
+            'output_tokens': int(headers.get('x-amzn-bedrock-output-token-count', 0)),
+            'cache_read_tokens': int(headers.get('x-amzn-bedrock-cache-read-input-token-count', 0)),
+            'cache_write_tokens': int(headers.get('x-amzn-bedrock-cache-write-input-token-count', 0)),
+        }
+        return json.loads(model_response['body'].read()), usage
+
+    async def _generate_text(
+        self,
+        prompt: str,
+        model_id: Optional[str] = None,
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+    ) -> str:
+        """
+        Generate text with a model outside the main answer path (e.g. summaries).
+        
+        Args:
+            prompt: The prompt text to send to the model
+            model_id: Model to use (defaults to the model_id valve)
+            max_tokens: Response token limit (defaults to the max_tokens valve)
+            temperature: Sampling temperature (defaults to the temperature valve)
+            
+        Returns:
+            The generated text
+            
+        Raises:
+            ClientError: For AWS-specific errors
+        """
+        await self._ensure_clients()
+        request_body = self._get_model_request_body(prompt, model_id, max_tokens, temperature)
+        response_body, usage = await self._call_bedrock(
+            self._invoke_model_sync,
+            request_body,
+            model_id,
+            model_tokens=estimate_tokens(prompt) + (max_tokens or self.valves.max_tokens),
+        )
+        self._record_token_usage(usage)
+        return self._parse_model_response(response_body, model_id)
+
+    def _record_token_usage(self, usage: Dict[str, int]) -> None:
+        """
+        Add model token usage to the metrics.
+        
+        Args:
+            usage: Token counts keyed by input_tokens / output_tokens /
+                cache_read_tokens / cache_write_tokens
+        """
+        self.metrics.increment(
+            "input_tokens_total", usage.get('input_tokens', 0), help_text="Model input tokens reported by Bedrock"
+        )
+        self.metrics.increment(
+            "output_tokens_total", usage.get('output_tokens', 0), help_text="Model output tokens reported by Bedrock"
+        )
+        self.metrics.increment(
+            "cache_read_input_tokens_total",
+            usage.get('cache_read_tokens', 0),
+            help_text="Input tokens read from the Bedrock prompt cache",
+        )
+        self.metrics.increment(
+            "cache_write_input_tokens_total",
+            usage.get('cache_write_tokens', 0),
+            help_text="Input tokens written to the Bedrock prompt cache",
+        )
+
+    def _open_model_stream_sync(self, request_body: Dict[str, Any]) -> Any:
+        """
+        Start a streaming model invocation.
+        
+        Args:
+            request_body: The model-specific request body
+            
+        Returns:
+            The botocore EventStream of response chunks
+        """
+        if self._get_model_codec().uses_converse:
+            return self.bedrock_client.converse_stream(modelId=self.valves.model_id, **request_body)['stream']
+        model_response = self.bedrock_client.invoke_model_with_response_stream(
+            modelId=self.valves.model_id,
+            body=json.dumps(request_body)
+        )
+        return model_response['body']
+
+    @staticmethod
+    def _status_key(__event_emitter__: Callable[[Dict[str, Any]], Awaitable[None]]) -> Any:
+        """Key a request's status tracker by chat and message ID, or by emitter when they are unknown."""
+        chat_id, message_id = extract_event_info(__event_emitter__)
+        if message_id is not None:
+            return (chat_id, message_id)
+        return id(__event_emitter__)
+
+    def _get_status_tracker(
+        self, __event_emitter__: Optional[Callable[[Dict[str, Any]], Awaitable[None]]]
+    ) -> Optional[StatusTracker]:
+        """
+        Get the status tracker of a request, creating it on first use.
+        
+        The tracker is forgotten once its final status is queued.
+        
+        Args:
+            __event_emitter__: The request's event emitter
+            
+        Returns:
+            The tracker, or None without an emitter
+        """
+        if not __event_emitter__:
+            return None
+        key = self._status_key(__event_emitter__)
+        tracker = self._status_trackers.get(key)
+        if tracker is None:
+            tracker = StatusTracker(
+                __event_emitter__,
+                self.valves.emit_interval,
+                self.valves.enable_status_indicator,
+                on_done=lambda: self._status_trackers.pop(key, None),
+            )
+            self._status_trackers[key] = tracker
+        return tracker
+
+    def _record_stage(
+        self,
+        __event_emitter__: Optional[Callable[[Dict[str, Any]], Awaitable[None]]],
+        stage: str,
+        started_at: float,
+    ) -> None:
+        """
+        Attach a stage duration to the request's final status.
+        
+        Args:
+            __event_emitter__: The request's event emitter
+            stage: Stage name (retrieval, generation, first_token, ...)
+            started_at: time.perf_counter() value taken when the stage started
+        """
+        if not __event_emitter__:
+            return
+        tracker = self._status_trackers.get(self._status_key(__event_emitter__))
+        if tracker is not None:
+            tracker.record(stage, time.perf_counter() - started_at)
+
+    def _finish_status(
+        self, __event_emitter__: Optional[Callable[[Dict[str, Any]], Awaitable[None]]], message: str
+    ) -> None:
+        """
+        Send a final status if the request does not have one yet.
+        
+        Args:
+            __event_emitter__: The request's event emitter
+            message: Final status message
+        """
+        if not __event_emitter__:
+            return
+        tracker = self._status_trackers.get(self._status_key(__event_emitter__))
+        if tracker is not None:
+            tracker.update("info", message, True)
+
+    async def emit_status(
+        self,
+        __event_emitter__: Optional[Callable[[dict], Awaitable[None]]],
+        level: str,
+        message: str,
+        done: bool,
+    ) -> None:
+        """
+        Emit status updates to the UI.
+        
+        Updates go through the request's StatusTracker, so this returns without
+        waiting for the UI. In-progress updates are coalesced to one per
+        emit_interval per request; the final update is sent immediately with the
+        request's stage timings appended.
+        
+        Args:
+            __event_emitter__: Callable function to emit events
+            level: Status level (info, warning, error)
+            message: Status message to display
+            done: Whether this is the final status update
+        """
+        tracker = self._get_status_tracker(__event_emitter__)
+        if tracker is not None:
+            tracker.update(level, message, done)
+
+    def _format_conversation_history(self, messages: List[Dict[str, str]]) -> str:
+        """
+        Format conversation history for context.
+        
+        The most recent messages are kept first, up to max_history_messages and
+        the max_history_tokens budget; a message that would overflow the budget
+        ends the history.
+        
+        Args:
+            messages: List of message dictionaries with 'role' and 'content' keys
+            
+        Returns:
+            Formatted conversation history as a string
+        """
+        if not self.valves.use_conversation_history or not messages:
+            return ""
+            
+        # Get the last N messages (excluding the current question)
+        history_messages = messages[:-1] if len(messages) > 1 else []
+        if len(history_messages) > self.valves.max_history_messages:
+            history_messages = history_messages[-self.valves.max_history_messages:]
+            
+        if not history_messages:
+            return ""
+            
+        header = "Previous conversation:\n\n"
+        budget = self.valves.max_history_tokens - estimate_tokens(header)
+        entries: List[str] = []
+        for msg in reversed(history_messages):
+            entry = format_history_entry(msg)
+            if entry is None:
+                continue
+            budget -= estimate_tokens(entry)
+            if budget < 0:
+                break
+            entries.append(entry)
+        
+        if not entries:
+            return ""
+        entries.append(header)
+        entries.reverse()
+        entries.append("\n")
+        return "".join(entries)
+    
+    def _get_chat_state_store(self) -> ChatStateStore:
+        """
+        Get the chat state store, rebuilding it when its valves change.
+        
+        Returns:
+            The chat state store for this pipe
+        """
+        store = self._chat_state_store
+        if (
+            store is None
+            or store.max_entries != self.valves.chat_state_cache_size
+            or store.db_path != self.valves.chat_state_path
+        ):
+            if store is not None:
+                store.close()
+            store = ChatStateStore(self.valves.chat_state_cache_size, self.valves.chat_state_path)
+            self._chat_state_store = store
+        return store
+
+    async def _load_chat_state(self, chat_id: Optional[str]) -> Optional[ChatState]:
+        """
+        Get the state of a chat, creating an empty one for new chats.
+        
+        Args:
+            chat_id: The OpenWebUI chat ID
+            
+        Returns:
+            The chat state, or None when there is no chat ID to key it on
+        """
+        if not chat_id:
+            return None
+        store = self._get_chat_state_store()
+        if store.persistent:
+            state = await self._run_blocking(store.get, chat_id)
+        else:
+            state = store.get(chat_id)
+        return state if state is not None else ChatState()
+
+    async def _save_chat_state(self, chat_id: str, state: ChatState) -> None:
+        """
+        Store the state of a chat.
+        
+        Args:
+            chat_id: The OpenWebUI chat ID
+            state: The chat state
+        """
+        store = self._get_chat_state_store()
+        if store.persistent:
+            await self._run_blocking(store.put, chat_id, state)
+        else:
+            store.put(chat_id, state)
+
+    async def _chat_history(self, messages: List[Dict[str, str]], chat_id: Optional[str]) -> str:
+        """
+        Format conversation history incrementally using the per-chat state.
+        
+        Only messages added since the previous turn are rendered. If the cached
+        prefix no longer matches the chat (a message was edited or the chat was
+        branched), the history is rebuilt. Without a chat ID this falls back to
+        _format_conversation_history.
+        
+        Args:
+            messages: List of message dictionaries with 'role' and 'content' keys
+            chat_id: The OpenWebUI chat ID (optional)
+            
+        Returns:
+            Formatted conversation history as a string
+        """
+        if not self.valves.use_conversation_history or not messages:
+            return ""
+        if not chat_id:
+            return self._format_conversation_history(messages)
+        
+        state = await self._load_chat_state(chat_id)
+        self._advance_chat_state(state, messages[:-1])
+        
+        if self.valves.enable_history_summarization:
+            self._schedule_history_summary(chat_id, state)
+        else:
+            # Without summarization older entries can never be used again
+            self._cap_history_entries(state)
+        
+        await self._save_chat_state(chat_id, state)
+        return self._render_chat_history(state)
+
+    @staticmethod
+    def _advance_chat_state(state: ChatState, history_messages: List[Dict[str, str]]) -> None:
+        """
+        Bring a chat state up to date with the chat's earlier messages.
+        
+        If the covered prefix no longer matches (a message was edited or
+        regenerated, or the chat was branched), the state is reset first.
+        Otherwise only the new messages are rendered.
+        
+        Args:
+            state: The chat state
+            history_messages: The chat's messages before the current question
+        """
+        covered = state.message_count
+        if covered > len(history_messages) or (
+            covered and message_fingerprint(history_messages[covered - 1]) != state.last_message_hash
+        ):
+            state.reset_history()
+            covered = 0
+        
+        for msg in history_messages[covered:]:
+            entry = format_history_entry(msg)
+            if entry is not None:
+                state.append_entry(entry)
+        if history_messages:
+            state.message_count = len(history_messages)
+            state.last_message_hash = message_fingerprint(history_messages[-1])
+
+    def _cap_history_entries(self, state: ChatState) -> None:
+        """Drop the oldest entries beyond max_history_messages, which can no longer be rendered."""
+        if len(state.entries) > self.valves.max_history_messages:
+            state.drop_oldest_entries(len(state.entries) - self.valves.max_history_messages)
+
+    async def _sync_bedrock_session(self, messages: List[Dict[str, str]], chat_id: Optional[str]) -> None:
+        """
+        Check the chat against its state before continuing its Bedrock session.
+        
+        RetrieveAndGenerate keeps the history server-side, so when an earlier
+        message was edited or regenerated the session holds stale turns; the
+        prefix check of _chat_history then drops the session ID.
+        
+        Args:
+            messages: List of message dictionaries with 'role' and 'content' keys
+            chat_id: The OpenWebUI chat ID (optional)
+        """
+        state = await self._load_chat_state(chat_id)
+        if state is None:
+            return
+        self._advance_chat_state(state, messages[:-1])
+        self._cap_history_entries(state)
+        await self._save_chat_state(chat_id, state)
+
+    def _render_chat_history(self, state: ChatState) -> str:
+        """
+        Render the rolling summary and the newest history entries within the history budget.
+        
+        Args:
+            state: The chat state
+            
+        Returns:
+            Formatted conversation history as a string
+        """
+        header = "Previous conversation:\n\n"
+        summary = ""
+        if state.summary:
+            summary = f"Summary of earlier conversation: {state.summary}\n\n"
+        budget = self.valves.max_history_tokens - estimate_tokens(header) - estimate_tokens(summary)
+        
+        selected: List[str] = []
+        for entry, tokens in zip(reversed(state.entries), reversed(state.entry_tokens)):
+            if len(selected) >= self.valves.max_history_messages:
+                break
+            budget -= tokens
+            if budget < 0:
+                break
+            selected.append(entry)
+        
+        if not selected and not summary:
+            return ""
+        selected.append(summary)
+        selected.append(header)
+        selected.reverse()
+        selected.append("\n")
+        return "".join(selected)
+
+    def _schedule_history_summary(self, chat_id: str, state: ChatState) -> None:
+        """
+        Start folding older entries into the rolling summary if the history is too large.
+        
+        Summarization runs in the background so the current turn is not delayed;
+        the turn uses the newest entries that fit the history budget meanwhile.
+        After a failure it is retried with exponential backoff, and entries
+        beyond max_history_messages are dropped until it succeeds again.
+        
+        Args:
+            chat_id: The OpenWebUI chat ID
+            state: The chat state
+        """
+        if state.summarizing or (
+            state.entries_total_tokens <= self.valves.summary_threshold_tokens
+            and len(state.entries) <= self.valves.max_history_messages
+        ):
+            return
+        if state.summary_backoff() > 0:
+            self._cap_history_entries(state)
+            return
+        
+        # Keep the newest entries that fit in half the threshold, fold the rest
+        keep_tokens = self.valves.summary_threshold_tokens // 2
+        kept = 0
+        for tokens in reversed(state.entry_tokens):
+            if kept >= self.valves.max_history_messages - 1 or keep_tokens - tokens < 0:
+                break
+            keep_tokens -= tokens
+            kept += 1
+        fold_count = len(state.entries) - kept
+        if fold_count <= 0:
+            return
+        
+        state.summarizing = True
+        task = asyncio.create_task(self._summarize_history(chat_id, state, fold_count, state.generation))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _summarize_history(self, chat_id: str, state: ChatState, fold_count: int, generation: int) -> None:
+        """
+        Fold the oldest history entries into the rolling summary using the summary model.
+        
+        Args:
+            chat_id: The OpenWebUI chat ID
+            state: The chat state
+            fold_count: Number of oldest entries to fold
+            generation: State generation the entries belong to
+        """
+        try:
+            prompt = HISTORY_SUMMARY_PROMPT.format(
+                summary=state.summary or "(none)", turns="".join(state.entries[:fold_count])
+            )
+            with self.metrics.time("summarize"):
+                summary = await self._generate_text(
+                    prompt, self.valves.summary_model_id, self.valves.summary_max_tokens
+                )
+            if state.generation != generation:
+                # The history was rebuilt while summarizing; these entries are gone
+                return
+            state.summary = summary.strip()
+            state.summary_tokens = estimate_tokens(state.summary)
+            state.summary_failures = 0
+            state.summary_failed_at = None
+            state.drop_oldest_entries(fold_count)
+            await self._save_chat_state(chat_id, state)
+        except Exception as e:
+            state.summary_failures += 1
+            state.summary_failed_at = time.monotonic()
+            logger.warning(
+                "History summarization for chat %s failed, retrying in %.0f s: %s",
+                chat_id,
+                state.summary_backoff(),
+                e,
+            )
+            # Entries beyond max_history_messages are never rendered; do not let them pile up
+            self._cap_history_entries(state)
+        finally:
+            state.summarizing = False
+
+    def _get_model_codec(self, model_id: Optional[str] = None) -> ModelCodec:
+        """
+        Get the codec for a model.
+        
+        Lookups are memoized per model ID, so a changed model_id valve is
+        resolved once and then reused.
+        
+        Args:
+            model_id: Model ID to look up (defaults to the model_id valve)
+            
+        Returns:
+            The model's codec
+        """
+        return resolve_model_codec(model_id or self.valves.model_id)
+
+    def _get_model_request_body(
+        self,
+        prompt: Union[str, PromptParts],
+        model_id: Optional[str] = None,
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """
+        Format the request body according to the model's requirements.
+        
+        Prompt caching checkpoints are added for split prompts when
+        enable_prompt_caching is on and the model supports prompt caching;
+        other models get the plain prompt.
+        
+        Args:
+            prompt: The prompt text to send to the model, or its parts
+            model_id: Model ID to format for (defaults to the model_id valve)
+            max_tokens: Response token limit (defaults to the max_tokens valve)
+            temperature: Sampling temperature (defaults to the temperature valve)
+            
+        Returns:
+            Dictionary containing the formatted request body (converse arguments
+            for models without a native codec)
+        """
+        return self._get_model_codec(model_id).request_body(
+            prompt,
+            max_tokens or self.valves.max_tokens,
+            self.valves.temperature if temperature is None else temperature,
+            self.valves.top_p,
+            cache=self.valves.enable_prompt_caching and supports_prompt_caching(model_id or self.valves.model_id),
+        )
+            
+    def _parse_model_response(self, response_body: Dict[str, Any], model_id: Optional[str] = None) -> str:
+        """
+        Parse the response body based on the model family.
+        
+        Args:
+            response_body: The parsed JSON response from the model
+            model_id: Model ID that produced the response (defaults to the model_id valve)
+            
+        Returns:
+            Extracted text from the model response
+        """
+        return self._get_model_codec(model_id).parse_response(response_body)
+
+    def _format_model_error(self, error: ClientError) -> str:
+        """
+        Turn a Bedrock Runtime ClientError into a user-facing message.
+        
+        Args:
+            error: The error raised by invoke_model or invoke_model_with_response_stream
+            
+        Returns:
+            The error message to show to the user
+        """
+        error_message = str(error)
+        logger.warning("AWS Bedrock ClientError: %s", error_message)
+        
+        if "AccessDeniedException" in error_message:
+            return "Error: Access denied to AWS Bedrock. Please check your AWS credentials and permissions."
+        elif "ValidationException" in error_message:
+            # Error handling for validation exceptions
+            return f"Error: Invalid request to AWS Bedrock. Please check your model ID and parameters. Details: {error_message}"
+        elif "ThrottlingException" in error_message:
+            return "Error: AWS Bedrock request was throttled. Please try again later."
+        elif "ServiceQuotaExceededException" in error_message:
+            return "Error: AWS Bedrock service quota exceeded. Please try again later or request a quota increase."
+        else:
+            return f"AWS Bedrock error: {error_message}"
+
+    def _format_knowledge_base_error(self, error: ClientError) -> str:
+        """
+        Turn a Bedrock Agent Runtime ClientError into a user-facing message.
+        
+        Args:
+            error: The error raised by retrieve
+            
+        Returns:
+            The error message to show to the user
+        """
+        if "ResourceNotFoundException" in str(error):
+            return f"Error: Knowledge Base ID '{', '.join(self._knowledge_base_ids())}' not found. Please check your Knowledge Base ID."
+        elif "AccessDeniedException" in str(error):
+            return "Error: Access denied to AWS Bedrock Knowledge Base. Please check your AWS credentials and permissions."
+        elif "ValidationException" in str(error):
+            return "Error: Invalid request to AWS Bedrock Knowledge Base. Please check your parameters."
+        else:
+            return f"AWS Bedrock Knowledge Base error: {str(error)}"
+
+    def _get_retrieval_cache(self) -> RetrievalCache:
+        """
+        Get the retrieval cache, rebuilding it when its valves change.
+        
+        Returns:
+            The retrieval cache for this pipe
+        """
+        cache = self._retrieval_cache
+        if (
+            cache is None
+            or cache.max_entries != self.valves.retrieval_cache_size
+            or cache.ttl_seconds != self.valves.retrieval_cache_ttl
+            or cache.db_path != self.valves.retrieval_cache_path
+        ):
+            if cache is not None:
+                cache.close()
+            cache = RetrievalCache(
+                self.valves.retrieval_cache_size,
+                self.valves.retrieval_cache_ttl,
+                self.valves.retrieval_cache_path,
+            )
+            self._retrieval_cache = cache
+        return cache
+
+    def invalidate_retrieval_cache(self, knowledge_base_id: Optional[str] = None) -> int:
+        """
+        Drop cached retrieval results, for example after a knowledge base sync.
+        
+        Args:
+            knowledge_base_id: Only drop entries for this knowledge base (all entries if None)
+            
+        Returns:
+            Number of in-memory entries removed
+        """
+        if self._retrieval_cache is None:
+            return 0
+        return self._retrieval_cache.invalidate(knowledge_base_id)
+
+    def retrieval_cache_stats(self) -> Dict[str, Any]:
+        """
+        Get retrieval cache hit/miss counters.
+        
+        Returns:
+            Dictionary with entries, hits, misses and hit_rate
+        """
+        return self._get_retrieval_cache().stats()
+
+    def _get_response_cache(self) -> Optional[ResponseCache]:
+        """
+        Get the response cache if it applies to the current valves.
+        
+        The cache is only used when enabled and the temperature is low enough for
+        answers to be reusable. It is rebuilt when its budget changes.
+        
+        Returns:
+            The response cache, or None if answers should not be cached
+        """
+        if (
+            not self.valves.enable_response_cache
+            or self.valves.temperature > self.valves.response_cache_max_temperature
+        ):
+            return None
+        cache = self._response_cache
+        if cache is None or cache.max_bytes != self.valves.response_cache_max_bytes:
+            cache = ResponseCache(self.valves.response_cache_max_bytes)
+            self._response_cache = cache
+        return cache
+
+    def response_cache_stats(self) -> Dict[str, Any]:
+        """
+        Get response cache counters, including the hit rate.
+        
+        Returns:
+            Dictionary with entries, size_bytes, hits, misses and hit_rate
+        """
+        if self._response_cache is None:
+            return ResponseCache(self.valves.response_cache_max_bytes).stats()
+        return self._response_cache.stats()
+
+    def _coalescing_key(
+        self, query: str, conversation_history: str, search_options: Dict[str, Any]
+    ) -> str:
+        """
+        Build the key under which identical in-flight requests are coalesced.
+        
+        Every valve that shapes the retrieval or the prompt is part of the key,
+        so a request arriving right after a valve change never joins a flight
+        built with the old settings.
+        
+        Args:
+            query: The user's question
+            conversation_history: Formatted conversation history
+            search_options: Resolved search type and metadata filter
+            
+        Returns:
+            The coalescing key
+        """
+        return json.dumps(
+            [
+                self._knowledge_base_ids(),
+                normalize_query(query),
+                self.valves.model_id,
+                self.valves.max_tokens,
+                self.valves.temperature,
+                self.valves.top_p,
+                self.valves.number_of_results,
+                self.valves.max_input_tokens,
+                self.valves.enable_prompt_caching,
+                [
+                    self.valves.enable_query_rewrite,
+                    self.valves.query_rewrite_model_id,
+                    self.valves.query_rewrite_temperature,
+                    self.valves.query_variants,
+                ],
+                [
+                    self.valves.enable_reranking,
+                    self.valves.reranker,
+                    self.valves.rerank_model_id,
+                    self.valves.rerank_overfetch_factor,
+                    self.valves.rerank_score_threshold,
+                ],
+                hashlib.sha256(conversation_history.encode("utf-8")).hexdigest(),
+                search_options,
+            ],
+            sort_keys=True,
+        )
+
+    def _record_coalesced(self, kind: str) -> None:
+        """Count a request that joined an in-flight identical request."""
+        self.metrics.increment(
+            "coalesced_requests_total",
+            help_text="Upstream Bedrock calls saved by joining an identical in-flight request",
+            kind=kind,
+        )
+
+    def coalescing_stats(self) -> Dict[str, int]:
+        """
+        Get request coalescing counters.
+        
+        Returns:
+            Dictionary with in_flight and saved (upstream calls avoided)
+        """
+        return self._coalescer.stats()
+
+    def _knowledge_base_ids(self) -> List[str]:
+        """
+        Get the configured knowledge base IDs.
+        
+        The knowledge_base_id valve accepts a single ID, a list, or a comma-separated string.
+        
+        Returns:
+            List of non-empty knowledge base IDs
+        """
+        configured = self.valves.knowledge_base_id
+        if isinstance(configured, str):
+            configured = configured.split(",")
+        return [kb_id.strip() for kb_id in configured if kb_id and kb_id.strip()]
+
+    def _search_options(
+        self, body: Optional[Dict[str, Any]] = None, user: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """
+        Resolve the search type and metadata filter for one request.
+        
+        The request body may set 'search_type' to override the valve, and
+        'metadata_filter' to narrow the valve's filter (both must match). Filter
+        variables are taken from the OpenWebUI user ($user.id, $user.email, ...)
+        and from the body's 'filter_variables' dictionary ($name).
+        
+        Args:
+            body: The OpenWebUI request body (optional)
+            user: The OpenWebUI user (optional)
+            
+        Returns:
+            Extra vectorSearchConfiguration fields (overrideSearchType, filter)
+            
+        Raises:
+            ValueError: If an override is invalid or a filter variable is not set
+        """
+        body = body or {}
+        search_type = str(body.get('search_type') or self.valves.search_type).upper()
+        if search_type and search_type not in SEARCH_TYPES:
+            raise ValueError(f"Search type must be one of: {', '.join(SEARCH_TYPES)}")
+        
+        variables = {**(body.get('filter_variables') or {}), 'user': user or {}}
+        filters = [
+            compile_metadata_filter(expression.strip()).render(variables)
+            for expression in (self.valves.metadata_filter, body.get('metadata_filter') or "")
+            if expression.strip()
+        ]
+        
+        options: Dict[str, Any] = {}
+        if search_type:
+            options['overrideSearchType'] = search_type
+        if filters:
+            options['filter'] = filters[0] if len(filters) == 1 else {'andAll': filters}
+        return options
+
+    def _retrieval_depth(self) -> int:
+        """
+        Get the number of results to retrieve per knowledge base.
+        
+        Returns:
+            number_of_results, or the over-fetched candidate count when reranking
+        """
+        if not self.valves.enable_reranking:
+            return self.valves.number_of_results
+        return min(100, self.valves.number_of_results * self.valves.rerank_overfetch_factor)
+
+    def _get_reranker(self) -> Any:
+        """
+        Get the reranker, rebuilding it when its valves change.
+        
+        Returns:
+            A reranker with a score(query, texts) method
+        """
+        key = (self.valves.reranker, self.valves.rerank_model_id)
+        if self._reranker is None or self._reranker_key != key:
+            self._reranker = RERANKERS[self.valves.reranker](self.valves.rerank_model_id)
+            self._reranker_key = key
+        return self._reranker
+
+    async def _rerank(self, query: str, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Rescore over-fetched candidates and keep the best number_of_results.
+        
+        Args:
+            query: The search query to score candidates against
+            results: Candidate retrievalResults
+            
+        Returns:
+            Kept results above rerank_score_threshold, best first
+        """
+        texts = [result.get('content', {}).get('text', '') for result in results]
+        reranker = self._get_reranker()
+        with self.metrics.time("rerank"):
+            if reranker.runs_in_executor:
+                scores = await self._run_blocking(reranker.score, query, texts)
+            else:
+                scores = reranker.score(query, texts)
+        if not any(scores):
+            # Nothing matched the query at all; keep the knowledge base's own ranking
+            return results[:self.valves.number_of_results]
+        return rerank_results(
+            results, scores, self.valves.number_of_results, self.valves.rerank_score_threshold
+        )
+
+    async def _retrieve(self, query: str, search_options: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """
+        Retrieve passages from all configured knowledge bases.
+        
+        Knowledge bases are queried concurrently, so wall-clock time is that of the
+        slowest one. Results from several knowledge bases are merged with
+        reciprocal rank fusion and de-duplicated, keeping the retrieval depth
+        (number_of_results, or more when reranking).
+        
+        Args:
+            query: The user's question to query the knowledge bases with
+            search_options: Search type and metadata filter from _search_options (optional)
+            
+        Returns:
+            The retrieved results, best first
+            
+        Raises:
+            ClientError: For AWS-specific errors
+        """
+        knowledge_base_ids = self._knowledge_base_ids()
+        if len(knowledge_base_ids) == 1:
+            return await self._retrieve_from_knowledge_base(knowledge_base_ids[0], query, search_options)
+        
+        result_lists = await asyncio.gather(
+            *(self._retrieve_from_knowledge_base(kb_id, query, search_options) for kb_id in knowledge_base_ids)
+        )
+        return fuse_retrieval_results(result_lists, limit=self._retrieval_depth())
+
+    async def _retrieve_from_knowledge_base(
+        self, knowledge_base_id: str, query: str, search_options: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Retrieve passages from one knowledge base, using the retrieval cache if enabled.
+        
+        Args:
+            knowledge_base_id: The knowledge base to query
+            query: The user's question to query the knowledge base with
+            search_options: Search type and metadata filter from _search_options (optional)
+            
+        Returns:
+            The retrievalResults returned by Bedrock
+            
+        Raises:
+            ClientError: For AWS-specific errors
+        """
+        number_of_results = self._retrieval_depth()
+        cache = None
+        if self.valves.enable_retrieval_cache:
+            cache = self._get_retrieval_cache()
+            key = RetrievalCache.make_key(knowledge_base_id, query, number_of_results, search_options)
+            if cache.persistent:
+                cached = await self._run_blocking(cache.get, key)
+            else:
+                cached = cache.get(key)
+            if cached is not None:
+                return cached
+        
+        response = await self._call_bedrock(
+            self.bedrock_agent_client.retrieve,
+            knowledgeBaseId=knowledge_base_id,
+            retrievalQuery={
+                'text': query
+            },
+            retrievalConfiguration={
+                'vectorSearchConfiguration': {
+                    'numberOfResults': number_of_results,
+                    **(search_options or {}),
+                }
+            }
+        )
+        retrieved_results = response.get('retrievalResults', [])
+        
+        if cache is not None:
+            if cache.persistent:
+                await self._run_blocking(cache.put, key, knowledge_base_id, retrieved_results)
+            else:
+                cache.put(key, knowledge_base_id, retrieved_results)
+        return retrieved_results
+
+    async def _rewrite_query(self, query: str, conversation_history: str) -> List[str]:
+        """
+        Turn the user's question into standalone search queries with query_rewrite_model_id.
+        
+        With query_variants above 1 the model also writes alternative phrasings,
+        which are retrieved concurrently and fused. Rewriting is skipped when it is
+        disabled or there is nothing to rewrite (no history and a single variant),
+        and falls back to the original question if the model call fails.
+        
+        Args:
+            query: The user's question
+            conversation_history: Formatted conversation history to resolve references against
+            
+        Returns:
+            The search queries, at least one
+        """
+        variants = self.valves.query_variants
+        if not self.valves.enable_query_rewrite or (not conversation_history.strip() and variants == 1):
+            return [query]
+        
+        if variants == 1:
+            instruction = "Write only the standalone query."
+        else:
+            instruction = (
+                f"Write {variants} different queries: the standalone query first, then alternative "
+                "phrasings that could match other relevant passages."
+            )
+        prompt = QUERY_REWRITE_PROMPT.format(
+            instruction=instruction, history=conversation_history.strip(), question=query
+        )
+        try:
+            with self.metrics.time("rewrite"):
+                response = await self._generate_text(
+                    prompt,
+                    self.valves.query_rewrite_model_id,
+                    max_tokens=64 * variants,
+                    temperature=self.valves.query_rewrite_temperature,
+                )
+        except Exception as e:
+            logger.warning("Query rewrite failed, retrieving with the original question: %s", e)
+            self.metrics.increment(
+                "query_rewrite_failures_total", help_text="Query rewrites that fell back to the original question"
+            )
+            return [query]
+        
+        queries = parse_rewritten_queries(response, variants)
+        logger.debug("Rewrote %r into %r", query, queries)
+        return queries or [query]
+
+    async def _prepare_prompt(
+        self, query: str, conversation_history: str = "", search_options: Optional[Dict[str, Any]] = None
+    ) -> Tuple[Optional[PromptParts], int, int]:
+        """
+        Retrieve passages from the knowledge base and build the generation prompt.
+        
+        Passages are fitted into what is left of max_input_tokens after the prompt
+        template, the question and the conversation history. The oldest history is
+        dropped when fewer than MIN_CONTEXT_TOKENS would remain. If query rewriting is
+        enabled, retrieval uses the rewritten queries while the prompt keeps the
+        original question.
+        
+        Args:
+            query: The user's question to query the knowledge base with
+            conversation_history: Formatted conversation history that shares the budget
+            search_options: Search type and metadata filter (defaults to the valves)
+            
+        Returns:
+            Tuple of (prompt parts, or None if nothing was found, estimated
+            prompt input tokens, number of passages included)
+            
+        Raises:
+            ClientError: For AWS-specific errors
+            PromptBudgetError: If the question alone exceeds the input token budget
+        """
+        if search_options is None:
+            search_options = self._search_options()
+        queries = await self._rewrite_query(query, conversation_history)
+        with self.metrics.time("retrieve"):
+            if len(queries) == 1:
+                retrieved_results = await self._retrieve(queries[0], search_options)
+            else:
+                result_lists = await asyncio.gather(
+                    *(self._retrieve(search_query, search_options) for search_query in queries)
+                )
+                retrieved_results = fuse_retrieval_results(result_lists, limit=self._retrieval_depth())
+        self.metrics.observe(
+            "retrieved_chunks",
+            len(retrieved_results),
+            buckets=CHUNK_COUNT_BUCKETS,
+            help_text="Chunks returned by knowledge base retrieval per request",
+        )
+        if self.valves.enable_reranking:
+            retrieved_results = await self._rerank(queries[0], retrieved_results)
+            self.metrics.observe(
+                "reranked_chunks",
+                len(retrieved_results),
+                buckets=CHUNK_COUNT_BUCKETS,
+                help_text="Chunks kept after reranking per request",
+            )
+        
+        if not retrieved_results:
+            return None, 0, 0
+        
+        with self.metrics.time("prompt_build"):
+            prompt_tokens = estimate_tokens(self._build_prompt(query, "", conversation_history).text())
+            context_budget = self.valves.max_input_tokens - prompt_tokens
+            if context_budget < MIN_CONTEXT_TOKENS and conversation_history:
+                # Give up older history before giving up passages
+                history_tokens = estimate_tokens(conversation_history)
+                conversation_history = trim_history(
+                    conversation_history, history_tokens - (MIN_CONTEXT_TOKENS - context_budget)
+                )
+                prompt_tokens = estimate_tokens(self._build_prompt(query, "", conversation_history).text())
+                context_budget = self.valves.max_input_tokens - prompt_tokens
+            if context_budget < MIN_CONTEXT_TOKENS:
+                raise PromptBudgetError(
+                    f"The question is too long to answer: it uses ~{prompt_tokens} of the "
+                    f"{self.valves.max_input_tokens} input tokens allowed, leaving no room for "
+                    "knowledge base passages. Please shorten it."
+                )
+            context, context_tokens, passages = build_context(retrieved_results, context_budget)
+            if not context:
+                return None, 0, 0
+            prompt = self._build_prompt(query, context, conversation_history)
+        return prompt, prompt_tokens + context_tokens, passages
+
+    def _build_prompt(self, query: str, context: str, conversation_history: str) -> PromptParts:
+        """
+        Build the generation prompt from the retrieved context and conversation history.
+        
+        The context comes before the history: the history grows every turn,
+        while the retrieved passages often repeat, so this order keeps the
+        longest prefix cacheable.
+        
+        Args:
+            query: The user's question
+            context: Formatted knowledge base passages
+            conversation_history: Formatted conversation history (may be empty)
+            
+        Returns:
+            The prompt parts to send to the model
+        """
+        return PromptParts(
+            system=SYSTEM_PROMPT,
+            context=f"The following information was retrieved from a knowledge base:\n\n{context}",
+            history=conversation_history.strip(),
+            question=f"Based on this information, please answer the following question:\n{query}",
+        )
+
+    def _report_prompt_size(self, progress: SharedProgress, passages: int, input_tokens: int) -> None:
+        """
+        Report how much of the input token budget a request uses.
+        
+        Args:
+            progress: Status of the request (shared by coalesced requests)
+            passages: Number of passages included in the prompt
+            input_tokens: Estimated prompt input tokens
+        """
+        logger.debug(
+            "Prompt uses %d passages, ~%d/%d input tokens", passages, input_tokens, self.valves.max_input_tokens
+        )
+        progress.update("info", f"Generating answer from {passages} passages (~{input_tokens} input tokens)...")
+
+    def _request_progress(
+        self, __event_emitter__: Optional[Callable[[Dict[str, Any]], Awaitable[None]]]
+    ) -> SharedProgress:
+        """Progress for work done for this request alone, reported to its status."""
+        progress = SharedProgress()
+        progress.attach(self._get_status_tracker(__event_emitter__))
+        return progress
+
+    async def query_knowledge_base(
+        self,
+        query: str,
+        chat_id: Optional[str],
+        conversation_history: str = "",
+        __event_emitter__: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
+        search_options: Optional[Dict[str, Any]] = None,
+        raise_errors: bool = False,
+    ) -> str:
+        """
+        Query the AWS Bedrock Knowledge Base and generate a response.
+        
+        With request coalescing enabled, identical concurrent questions share one
+        retrieve and invoke_model call.
+        
+        Args:
+            query: The user's question to query the knowledge base with
+            chat_id: The chat ID for context tracking (optional)
+            conversation_history: Formatted conversation history for context (optional)
+            __event_emitter__: Function to emit events for status updates (optional)
+            search_options: Search type and metadata filter from _search_options (optional)
+            raise_errors: Raise failures instead of returning them as the answer
             
-        @validator('number_of_results')
-        def validate_number_of_results(cls, v):
-            if v < 1 or v > 100:
-                raise ValueError('Number of results must be between 1 and 100')
-            return v
-
-    def __init__(self):
-        """Initialize the AWS Bedrock Knowledge Base pipe"""
-        self.type = "pipe"
-        self.id = "aws_bedrock_kb"
-        self.name = "AWS Bedrock Knowledge Base"
-        self.valves = self.Valves()
-        self.last_emit_time = 0
-        self.bedrock_client = None
-        self.bedrock_agent_client = None
-        self._clients_initialized = False
+        Returns:
+            Generated response based on knowledge base results, or an error message
+            
+        Raises:
+            BedrockRequestError: If raise_errors is set and the request fails
+        """
+        try:
+            if not self.valves.enable_request_coalescing:
+                return await self._query_knowledge_base(
+                    query, chat_id, conversation_history, self._request_progress(__event_emitter__), search_options
+                )
+            if search_options is None:
+                search_options = self._search_options()
+            return await self._coalescer.run(
+                self._coalescing_key(query, conversation_history, search_options),
+                lambda progress: self._query_knowledge_base(
+                    query, chat_id, conversation_history, progress, search_options
+                ),
+                self._get_status_tracker(__event_emitter__),
+            )
+        except BedrockRequestError as e:
+            if raise_errors:
+                raise
+            return str(e)
 
-    def _initialize_clients(self) -> None:
+    async def _query_knowledge_base(
+        self,
+        query: str,
+        chat_id: Optional[str],
+        conversation_history: str = "",
+        progress: Optional[SharedProgress] = None,
+        search_options: Optional[Dict[str, Any]] = None,
+    ) -> str:
         """
-        Initialize AWS Bedrock clients with credentials.
+        Answer a question without request coalescing (see query_knowledge_base).
         
-        This method creates boto3 clients for Bedrock Runtime and Bedrock Agent Runtime
-        using the configured AWS credentials. It only initializes the clients if they
-        haven't been initialized already.
+        Status updates and stage timings go to progress rather than to a single
+        request's emitter, so coalesced requests all receive them.
         
         Raises:
-            Exception: If client initialization fails
+            BedrockRequestError: If retrieval or generation fails
         """
-        if not self._clients_initialized:
-            session_kwargs = {
-                'aws_access_key_id': self.valves.aws_access_key_id,
-                'aws_secret_access_key': self.valves.aws_secret_access_key,
-                'region_name': self.valves.aws_region
-            }
+        await self._ensure_clients()
+        if progress is None:
+            progress = SharedProgress()
+        
+        try:
+            retrieval_started_at = time.perf_counter()
+            prompt, input_tokens, passages = await self._prepare_prompt(query, conversation_history, search_options)
+            progress.record("retrieval", retrieval_started_at)
             
-            # Add session token if provided
-            if self.valves.aws_session_token:
-                session_kwargs['aws_session_token'] = self.valves.aws_session_token
-                
-            session = boto3.Session(**session_kwargs)
+            # If no results were found
+            if not prompt:
+                return NO_RESULTS_MESSAGE
+            self._report_prompt_size(progress, passages, input_tokens)
             
+            # Generate a response using the retrieved context and conversation history
             try:
-                self.bedrock_client = session.client('bedrock-runtime')
-                self.bedrock_agent_client = session.client('bedrock-agent-runtime')
-                self._clients_initialized = True
-            except Exception as e:
-                self._clients_initialized = False
-                raise Exception(f"Failed to initialize AWS clients: {str(e)}")
+                request_body = self._get_model_request_body(prompt)
+                response_cache = self._get_response_cache()
+                if response_cache is not None:
+                    cache_key = ResponseCache.fingerprint(self.valves.model_id, request_body)
+                    cached_answer = response_cache.get(cache_key)
+                    if cached_answer is not None:
+                        return cached_answer
+                
+                logger.debug("Sending request to model %s (~%d input tokens)", self.valves.model_id, input_tokens)
+                
+                generation_started_at = time.perf_counter()
+                with self.metrics.time("invoke_model"):
+                    response_body, usage = await self._call_bedrock(
+                        self._invoke_model_sync,
+                        request_body,
+                        model_tokens=input_tokens + self.valves.max_tokens,
+                    )
+                progress.record("generation", generation_started_at)
+                self._record_token_usage(usage)
 
-    async def emit_status(
+                # Parse response using our helper method
+                with self.metrics.time("parse"):
+                    answer = self._parse_model_response(response_body)
+                logger.debug("Model %s returned %d characters", self.valves.model_id, len(answer))
+                if response_cache is not None:
+                    response_cache.put(cache_key, answer)
+                return answer
+                
+            except ClientError as e:
+                raise BedrockRequestError(self._format_model_error(e)) from e
+                    
+        except BedrockRequestError:
+            raise
+        except ClientError as e:
+            raise BedrockRequestError(self._format_knowledge_base_error(e)) from e
+        except Exception as e:
+            raise BedrockRequestError(f"Error querying knowledge base: {str(e)}") from e
+
+    async def stream_knowledge_base(
         self,
-        __event_emitter__: Optional[Callable[[dict], Awaitable[None]]],
-        level: str,
-        message: str,
-        done: bool,
-    ) -> None:
+        query: str,
+        chat_id: Optional[str],
+        conversation_history: str = "",
+        __event_emitter__: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
+        search_options: Optional[Dict[str, Any]] = None,
+    ) -> AsyncGenerator[str, None]:
         """
-        Emit status updates to the UI.
+        Query the AWS Bedrock Knowledge Base and stream the generated response.
+        
+        Retrieval works exactly as in query_knowledge_base; generation uses
+        invoke_model_with_response_stream and yields text deltas as Bedrock emits them.
+        Errors are yielded as text, matching the messages of query_knowledge_base.
+        With request coalescing enabled, identical concurrent questions share one
+        stream; late joiners get the chunks emitted so far replayed first.
         
         Args:
-            __event_emitter__: Callable function to emit events
-            level: Status level (info, warning, error)
-            message: Status message to display
-            done: Whether this is the final status update
-        """
-        if not __event_emitter__:
-            return
+            query: The user's question to query the knowledge base with
+            chat_id: The chat ID for context tracking (optional)
+            conversation_history: Formatted conversation history for context (optional)
+            __event_emitter__: Function to emit events for status updates (optional)
+            search_options: Search type and metadata filter from _search_options (optional)
             
-        current_time = time.time()
-        if (
-            self.valves.enable_status_indicator
-            and (
-                current_time - self.last_emit_time >= self.valves.emit_interval or done
+        Yields:
+            Text deltas of the generated response
+        """
+        if not self.valves.enable_request_coalescing:
+            source = self._stream_knowledge_base(
+                query, chat_id, conversation_history, self._request_progress(__event_emitter__), search_options
             )
-        ):
-            await __event_emitter__(
-                {
-                    "type": "status",
-                    "data": {
-                        "status": "complete" if done else "in_progress",
-                        "level": level,
-                        "description": message,
-                        "done": done,
-                    },
-                }
+        else:
+            if search_options is None:
+                search_options = self._search_options()
+            source = self._coalescer.stream(
+                self._coalescing_key(query, conversation_history, search_options),
+                lambda progress: self._stream_knowledge_base(
+                    query, chat_id, conversation_history, progress, search_options
+                ),
+                self._get_status_tracker(__event_emitter__),
             )
-            self.last_emit_time = current_time
+        async for chunk in source:
+            yield chunk
 
-    def _format_conversation_history(self, messages: List[Dict[str, str]]) -> str:
-        """
-        Format conversation history for context.
+    async def _stream_knowledge_base(
+        self,
+        query: str,
+        chat_id: Optional[str],
+        conversation_history: str = "",
+        progress: Optional[SharedProgress] = None,
+        search_options: Optional[Dict[str, Any]] = None,
+    ) -> AsyncGenerator[str, None]:
+        """Stream an answer without request coalescing (see stream_knowledge_base and _query_knowledge_base)."""
+        await self._ensure_clients()
+        if progress is None:
+            progress = SharedProgress()
         
-        Args:
-            messages: List of message dictionaries with 'role' and 'content' keys
-            
-        Returns:
-            Formatted conversation history as a string
-        """
-        if not self.valves.use_conversation_history or not messages:
-            return ""
+        try:
+            retrieval_started_at = time.perf_counter()
+            prompt, input_tokens, passages = await self._prepare_prompt(query, conversation_history, search_options)
+            progress.record("retrieval", retrieval_started_at)
+        except ClientError as e:
+            yield self._format_knowledge_base_error(e)
+            return
+        except Exception as e:
+            yield f"Error querying knowledge base: {str(e)}"
+            return
+        
+        if not prompt:
+            yield NO_RESULTS_MESSAGE
+            return
+        self._report_prompt_size(progress, passages, input_tokens)
+        
+        stream = None
+        try:
+            request_body = self._get_model_request_body(prompt)
+            response_cache = self._get_response_cache()
+            if response_cache is not None:
+                cache_key = ResponseCache.fingerprint(self.valves.model_id, request_body)
+                cached_answer = response_cache.get(cache_key)
+                if cached_answer is not None:
+                    yield cached_answer
+                    return
             
-        # Get the last N messages (excluding the current question)
-        history_messages = messages[:-1] if len(messages) > 1 else []
-        if len(history_messages) > self.valves.max_history_messages:
-            history_messages = history_messages[-self.valves.max_history_messages:]
+            codec = self._get_model_codec()
+            logger.debug("Sending streaming request to model %s (~%d input tokens)", self.valves.model_id, input_tokens)
             
-        if not history_messages:
-            return ""
+            started_at = time.perf_counter()
+            stream = await self._call_bedrock(
+                self._open_model_stream_sync,
+                request_body,
+                model_tokens=input_tokens + self.valves.max_tokens,
+            )
+            events = iter(stream)
+            parts: List[str] = []
+            while True:
+                # Each read blocks on the network, so pull events through the thread pool
+                event = await self._run_blocking(next, events, None)
+                if event is None:
+                    break
+                payload = codec.stream_payload(event)
+                if not payload:
+                    continue
+                usage = codec.stream_usage(payload)
+                if usage:
+                    self._record_token_usage(usage)
+                text = codec.decode_stream_chunk(payload)
+                if text:
+                    if not parts:
+                        self.metrics.observe(
+                            "stage_duration_seconds", time.perf_counter() - started_at, stage="first_token"
+                        )
+                    parts.append(text)
+                    yield text
+            self.metrics.observe(
+                "stage_duration_seconds", time.perf_counter() - started_at, stage="invoke_model"
+            )
             
-        formatted_history = "Previous conversation:\n\n"
-        for msg in history_messages:
-            role = msg.get("role", "")
-            content = msg.get("content", "")
-            if role == "user":
-                formatted_history += f"User: {content}\n\n"
-            elif role == "assistant":
-                formatted_history += f"Assistant: {content}\n\n"
-                
-        return formatted_history + "\n"
-    
-    def _get_model_family(self) -> str:
+            if response_cache is not None:
+                response_cache.put(cache_key, "".join(parts))
+        except ClientError as e:
+            yield self._format_model_error(e)
+        except Exception as e:
+            yield f"Error querying knowledge base: {str(e)}"
+        finally:
+            # Release the HTTP connection if the user aborted mid-stream
+            if stream is not None:
+                stream.close()
+
+    def _model_arn(self) -> str:
         """
-        Determine the model family based on the model_id.
+        Get the model identifier for RetrieveAndGenerate.
+        
+        Foundation model IDs are expanded to their ARN; ARNs and cross-region
+        inference profile IDs are passed through unchanged.
+        
+        Returns:
+            The modelArn value
         """
         model_id = self.valves.model_id
-        if model_id.startswith(ModelFamily.CLAUDE3):
-            return ModelFamily.CLAUDE3
-        elif model_id.replace('eu.', '').startswith(ModelFamily.NOVA):
-            return ModelFamily.NOVA
-        else:
-            raise ValueError(f"Unsupported model ID: {model_id}. Only Claude 3 and Nova models are supported.")
-    
-    def _get_model_request_body(self, prompt: str) -> Dict[str, Any]:
+        if model_id.startswith("arn:") or base_model_id(model_id) != model_id:
+            return model_id
+        return f"arn:aws:bedrock:{self.valves.aws_region}::foundation-model/{model_id}"
+
+    def _retrieve_and_generate_request(
+        self, query: str, session_id: Optional[str], search_options: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
         """
-        Format the request body according to the model's requirements.
+        Build the arguments for retrieve_and_generate / retrieve_and_generate_stream.
+        
+        RetrieveAndGenerate accepts a single knowledge base, so only the first
+        configured one is used.
         
         Args:
-            prompt: The prompt text to send to the model
+            query: The user's question
+            session_id: Bedrock session to continue, or None to start a new one
+            search_options: Search type and metadata filter from _search_options (optional)
             
         Returns:
-            Dictionary containing the formatted request body
-            
-        Raises:
-            ValueError: If the model ID is not supported
+            Keyword arguments for the Bedrock Agent Runtime call
         """
-            # Base parameters for Claude 3 models
-        base_params = {
-            "max_tokens": self.valves.max_tokens,
-            "temperature": self.valves.temperature,
-            "top_p": self.valves.top_p,
+        request = {
+            'input': {'text': query},
+            'retrieveAndGenerateConfiguration': {
+                'type': 'KNOWLEDGE_BASE',
+                'knowledgeBaseConfiguration': {
+                    'knowledgeBaseId': self._knowledge_base_ids()[0],
+                    'modelArn': self._model_arn(),
+                    'retrievalConfiguration': {
+                        'vectorSearchConfiguration': {
+                            'numberOfResults': self.valves.number_of_results,
+                            **(search_options or {}),
+                        }
+                    },
+                    'generationConfiguration': {
+                        'inferenceConfig': {
+                            'textInferenceConfig': {
+                                'maxTokens': self.valves.max_tokens,
+                                'temperature': self.valves.temperature,
+                                'topP': self.valves.top_p,
+                            }
+                        }
+                    },
+                },
+            },
         }
-        model_family = self._get_model_family()
-        if model_family == ModelFamily.CLAUDE3:
-            return {
-                "anthropic_version": "bedrock-2023-05-31",
-                **base_params,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ]
-            }
-        elif model_family == ModelFamily.NOVA:                
-            return {
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {"text": prompt}
-                            ]
-                    }
-                ]
-            }
-        
-        else:
-            raise ValueError(f"Unsupported model ID: {self.valves.model_id}. Only Claude 3 and Nova models are supported.")
-            
-    def _parse_model_response(self, response_body: Dict[str, Any]) -> str:
+        if session_id:
+            request['sessionId'] = session_id
+        return request
+
+    @staticmethod
+    def _is_expired_session_error(error: ClientError) -> bool:
+        """Whether a RetrieveAndGenerate error means the Bedrock session is no longer valid."""
+        code = error.response.get('Error', {}).get('Code')
+        message = error.response.get('Error', {}).get('Message', '')
+        return code in ('ValidationException', 'ResourceNotFoundException') and 'session' in message.lower()
+
+    async def _call_retrieve_and_generate(
+        self,
+        operation: Callable[..., Any],
+        query: str,
+        chat_id: Optional[str],
+        search_options: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
         """
-        Parse the response body based on the model family.
+        Call a RetrieveAndGenerate operation, continuing the chat's Bedrock session.
+        
+        If Bedrock no longer knows the session (sessions expire), the call is
+        repeated once with a new session.
         
         Args:
-            response_body: The parsed JSON response from the model
+            operation: bedrock_agent_client.retrieve_and_generate or its streaming variant
+            query: The user's question
+            chat_id: The chat ID the Bedrock session belongs to (optional)
+            search_options: Search type and metadata filter (defaults to the valves)
             
         Returns:
-            Extracted text from the model response
-            
-        Raises:
-            ValueError: If the model ID is not supported
-        """
-        model_family = self._get_model_family()
-        if model_family == ModelFamily.CLAUDE3:
-            return response_body['content'][0]['text']
-        elif model_family == ModelFamily.NOVA:
-            # Nova returns a list of results, each with outputText
-            return response_body.get("output", [{}]).get("message", "").get("content", "")[0].get("text", "")
-        else:
-            raise ValueError(f"Unsupported model ID: {self.valves.model_id}. Only Claude 3 and Nova models are supported.")
+            The raw Bedrock response
+        """
+        if search_options is None:
+            search_options = self._search_options()
+        state = await self._load_chat_state(chat_id)
+        session_id = state.bedrock_session_id if state is not None else None
+        model_tokens = estimate_tokens(query) + self.valves.max_tokens
+        try:
+            response = await self._call_bedrock(
+                operation, **self._retrieve_and_generate_request(query, session_id, search_options), model_tokens=model_tokens
+            )
+        except ClientError as e:
+            if not session_id or not self._is_expired_session_error(e):
+                raise
+            logger.debug("Bedrock session for chat %s expired, starting a new one", chat_id)
+            response = await self._call_bedrock(
+                operation, **self._retrieve_and_generate_request(query, None, search_options), model_tokens=model_tokens
+            )
+        if state is not None:
+            state.bedrock_session_id = response.get('sessionId')
+            await self._save_chat_state(chat_id, state)
+        return response
 
-    async def query_knowledge_base(self, query: str, chat_id: Optional[str], conversation_history: str = "") -> str:
+    async def query_retrieve_and_generate(
+        self,
+        query: str,
+        chat_id: Optional[str],
+        search_options: Optional[Dict[str, Any]] = None,
+        raise_errors: bool = False,
+    ) -> str:
         """
-        Query the AWS Bedrock Knowledge Base and generate a response.
+        Answer a question with a single Bedrock RetrieveAndGenerate call.
+        
+        The Bedrock session is kept per chat_id, so follow-up turns use the
+        server-side conversation context instead of resending history.
         
         Args:
-            query: The user's question to query the knowledge base with
-            chat_id: The chat ID for context tracking (optional)
-            conversation_history: Formatted conversation history for context (optional)
+            query: The user's question
+            chat_id: The chat ID used to continue the Bedrock session (optional)
+            search_options: Search type and metadata filter from _search_options (optional)
+            raise_errors: Raise failures instead of returning them as the answer
             
         Returns:
-            Generated response based on knowledge base results
+            Generated response, or an error message
             
         Raises:
-            ClientError: For AWS-specific errors
-            Exception: For general errors during the query process
+            BedrockRequestError: If raise_errors is set and the request fails
+        """
+        await self._ensure_clients()
+        try:
+            with self.metrics.time("retrieve_and_generate"):
+                response = await self._call_retrieve_and_generate(
+                    self.bedrock_agent_client.retrieve_and_generate, query, chat_id, search_options
+                )
+            return response.get('output', {}).get('text', '') or NO_RESULTS_MESSAGE
+        except ClientError as e:
+            error_message = self._format_knowledge_base_error(e)
+        except Exception as e:
+            error_message = f"Error querying knowledge base: {str(e)}"
+        if raise_errors:
+            raise BedrockRequestError(error_message)
+        return error_message
+
+    async def stream_retrieve_and_generate(
+        self, query: str, chat_id: Optional[str], search_options: Optional[Dict[str, Any]] = None
+    ) -> AsyncGenerator[str, None]:
         """
-        self._initialize_clients()
+        Stream an answer from Bedrock RetrieveAndGenerateStream.
         
+        Args:
+            query: The user's question
+            chat_id: The chat ID used to continue the Bedrock session (optional)
+            search_options: Search type and metadata filter from _search_options (optional)
+            
+        Yields:
+            Text deltas of the generated response, or an error message
+        """
+        await self._ensure_clients()
+        stream = None
         try:
-            # Query the knowledge base
-            response = self.bedrock_agent_client.retrieve(
-                knowledgeBaseId=self.valves.knowledge_base_id,
-                retrievalQuery={
-                    'text': query
-                },
-                retrievalConfiguration={
-                    'vectorSearchConfiguration': {
-                        'numberOfResults': self.valves.number_of_results
-                    }
-                }
+            started_at = time.perf_counter()
+            response = await self._call_retrieve_and_generate(
+                self.bedrock_agent_client.retrieve_and_generate_stream, query, chat_id, search_options
             )
+            stream = response['stream']
+            events = iter(stream)
+            first_token = True
+            while True:
+                event = await self._run_blocking(next, events, None)
+                if event is None:
+                    break
+                text = event.get('output', {}).get('text')
+                if text:
+                    if first_token:
+                        self.metrics.observe(
+                            "stage_duration_seconds", time.perf_counter() - started_at, stage="first_token"
+                        )
+                        first_token = False
+                    yield text
+            self.metrics.observe(
+                "stage_duration_seconds", time.perf_counter() - started_at, stage="retrieve_and_generate"
+            )
+        except ClientError as e:
+            yield self._format_knowledge_base_error(e)
+        except Exception as e:
+            yield f"Error querying knowledge base: {str(e)}"
+        finally:
+            if stream is not None:
+                stream.close()
+
+    async def _answer_batch_item(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Answer one normalized batch item.
+        
+        Args:
+            item: Batch item with 'id' and 'messages'
             
-            # Extract retrieved passages
-            retrieved_results = response.get('retrievalResults', [])
-            context = ""
-            
-            # Add source information to each result
-            for i, result in enumerate(retrieved_results, 1):
-                if 'content' in result and 'text' in result['content']:
-                    content = result['content']['text']
-                    source = ""
-                    if 'location' in result:
-                        source = f" (Source: {result['location'].get('s3Location', {}).get('uri', 'Unknown')})"
-                    context += f"[Document {i}{source}]\n{content}\n\n"
-            
-            # If no results were found
-            if not context:
-                return "I couldn't find any relevant information in the knowledge base."
-            
-            # Generate a response using the retrieved context and conversation history
-            prompt = f"""
-            {conversation_history}
-            
-            The following information was retrieved from a knowledge base:
+        Returns:
+            Result with id, question, answer, error and latency_ms
+        """
+        started_at = time.perf_counter()
+        messages = item["messages"]
+        question = messages[-1].get("content", "")
+        result: Dict[str, Any] = {"id": item["id"], "question": question, "answer": None, "error": None}
+        try:
+            if self.valves.generation_mode == "retrieve_and_generate":
+                result["answer"] = await self.query_retrieve_and_generate(
+                    question, None, self._search_options(item), raise_errors=True
+                )
+            else:
+                conversation_history = self._format_conversation_history(messages)
+                result["answer"] = await self.query_knowledge_base(
+                    question, None, conversation_history, search_options=self._search_options(item), raise_errors=True
+                )
+        except Exception as e:
+            result["error"] = str(e)
+        result["latency_ms"] = round((time.perf_counter() - started_at) * 1000, 1)
+        return result
+
+    async def batch_query(
+        self,
+        questions: Iterable[Union[str, Dict[str, Any]]],
+        concurrency: Optional[int] = None,
+        checkpoint_path: Optional[str] = None,
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        Answer many questions with bounded concurrency, yielding results as they complete.
+        
+        Items may be plain question strings or dictionaries in the shape accepted by
+        normalize_batch_item. Failed or malformed items are yielded with 'error' set.
+        With a checkpoint file, every successful result is appended to it as JSON
+        and items whose id is already in the file are skipped, so an interrupted
+        run can be resumed and retries the failures.
+        
+        Args:
+            questions: Questions or batch item dictionaries
+            concurrency: Items processed at once (defaults to max_concurrent_requests)
+            checkpoint_path: JSONL file to record finished results in (optional)
             
-            {context}
+        Yields:
+            Result dictionaries with id, question, answer, error and latency_ms,
+            in completion order
             
-            Based on this information, please answer the following question:
-            {query}
+        Raises:
+            Exception: If iterating over questions fails (e.g. a malformed JSONL line)
+        """
+        completed = load_batch_checkpoint(checkpoint_path) if checkpoint_path else set()
+        pending = enumerate(questions)
+        results: "asyncio.Queue[Union[Dict[str, Any], Exception, None]]" = asyncio.Queue()
+        worker_count = concurrency or self.valves.max_concurrent_requests
+
+        async def worker() -> None:
+            try:
+                for index, raw in pending:
+                    try:
+                        item = normalize_batch_item(raw, index)
+                    except Exception as e:
+                        await results.put({
+                            "id": batch_item_id(raw, index),
+                            "question": None,
+                            "answer": None,
+                            "error": str(e),
+                            "latency_ms": 0.0,
+                        })
+                        continue
+                    if item["id"] not in completed:
+                        await results.put(await self._answer_batch_item(item))
+            except Exception as e:
+                # Reading the input failed; hand the error to the caller
+                await results.put(e)
+            finally:
+                await results.put(None)
+
+        workers: List["asyncio.Task[None]"] = []
+        checkpoint = None
+        try:
+            # Open the checkpoint first so a failure here cannot strand running workers
+            if checkpoint_path:
+                checkpoint = open(checkpoint_path, "a", encoding="utf-8")
+            workers = [asyncio.create_task(worker()) for _ in range(worker_count)]
+            finished_workers = 0
+            while finished_workers < worker_count:
+                result = await results.get()
+                if result is None:
+                    finished_workers += 1
+                    continue
+                if isinstance(result, Exception):
+                    raise result
+                if checkpoint is not None and result["error"] is None:
+                    checkpoint.write(json.dumps(result) + "\n")
+                    checkpoint.flush()
+                yield result
+        finally:
+            for task in workers:
+                task.cancel()
+            if checkpoint is not None:
+                checkpoint.close()
+
+    async def batch_query_file(
+        self,
+        path: str,
+        concurrency: Optional[int] = None,
+        checkpoint_path: Optional[str] = None,
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        Answer the questions in a JSONL file (e.g. in the shape of requests.jsonl).
+        
+        Args:
+            path: JSONL file with one batch item per line
+            concurrency: Items processed at once (defaults to max_concurrent_requests)
+            checkpoint_path: JSONL file to record finished results in (optional)
             
-            If the information doesn't contain a clear answer, please say so.
-            """
+        Yields:
+            Result dictionaries, in completion order
+        """
+        async for result in self.batch_query(read_jsonl(path), concurrency, checkpoint_path):
+            yield result
+
+    async def submit_batch_inference_job(
+        self,
+        questions: Iterable[Union[str, Dict[str, Any]]],
+        input_s3_uri: str,
+        output_s3_uri: str,
+        role_arn: str,
+        job_name: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Run retrieval locally and submit generation as a Bedrock batch inference job.
+        
+        Batch inference is billed at a lower rate than on-demand invocation but
+        finishes asynchronously; results land in output_s3_uri. Bedrock requires a
+        minimum number of records per job (see the Bedrock batch inference quotas).
+        
+        Args:
+            questions: Questions or batch item dictionaries
+            input_s3_uri: s3://bucket/key.jsonl to upload the model inputs to
+            output_s3_uri: s3://bucket/prefix/ for the job output
+            role_arn: IAM role Bedrock assumes to read and write the S3 locations
+            job_name: Name of the job (generated if not given)
             
-            try:
-                request_body = self._get_model_request_body(prompt)
-                print(f"DEBUG - Sending request to model {self.valves.model_id}: {json.dumps(request_body)}")
-                
-                model_response = self.bedrock_client.invoke_model(
-                    modelId=self.valves.model_id,
-                    body=json.dumps(request_body)
-                )
+        Returns:
+            Dictionary with jobArn (None if no record could be built), records,
+            skipped (items without retrieved context) and failed (a list of
+            {'id', 'error'} for items that were malformed or whose retrieval failed)
+        """
+        await self._ensure_clients()
+        if not input_s3_uri.startswith("s3://") or "/" not in input_s3_uri[5:]:
+            raise ValueError(f"Invalid S3 URI for batch input: {input_s3_uri}")
+        semaphore = asyncio.Semaphore(self.valves.max_concurrent_requests)
+        failed: List[Dict[str, str]] = []
 
-                # Parse response using our helper method
-                response_body = json.loads(model_response['body'].read())
-                print(f"DEBUG - Raw response from model: {json.dumps(response_body)}")
-                
-                return self._parse_model_response(response_body)
-                
+        async def build_record(raw: Union[str, Dict[str, Any]], index: int) -> Optional[Dict[str, Any]]:
+            item_id = batch_item_id(raw, index)
+            try:
+                item = normalize_batch_item(raw, index)
+                messages = item["messages"]
+                async with semaphore:
+                    prompt, _, _ = await self._prepare_prompt(
+                        messages[-1].get("content", ""),
+                        self._format_conversation_history(messages),
+                        self._search_options(item),
+                    )
             except ClientError as e:
-                error_message = str(e)
-                print(f"DEBUG - AWS Bedrock ClientError: {error_message}")
-                
-                if "AccessDeniedException" in error_message:
-                    return "Error: Access denied to AWS Bedrock. Please check your AWS credentials and permissions."
-                elif "ValidationException" in error_message:
-                    # Error handling for validation exceptions
-                    return f"Error: Invalid request to AWS Bedrock. Please check your model ID and parameters. Details: {error_message}"
-                elif "ThrottlingException" in error_message:
-                    return "Error: AWS Bedrock request was throttled. Please try again later."
-                elif "ServiceQuotaExceededException" in error_message:
-                    return "Error: AWS Bedrock service quota exceeded. Please try again later or request a quota increase."
-                else:
-                    return f"AWS Bedrock error: {error_message}"
-                    
-        except ClientError as e:
-            if "ResourceNotFoundException" in str(e):
-                return f"Error: Knowledge Base ID '{self.valves.knowledge_base_id}' not found. Please check your Knowledge Base ID."
-            elif "AccessDeniedException" in str(e):
-                return "Error: Access denied to AWS Bedrock Knowledge Base. Please check your AWS credentials and permissions."
-            elif "ValidationException" in str(e):
-                return "Error: Invalid request to AWS Bedrock Knowledge Base. Please check your parameters."
+                error = self._format_knowledge_base_error(e)
+            except Exception as e:
+                error = str(e)
             else:
-                return f"AWS Bedrock Knowledge Base error: {str(e)}"
+                if not prompt:
+                    return None
+                return {"recordId": item["id"], "modelInput": self._get_model_request_body(prompt)}
+            logger.warning("Skipping batch item %s: %s", item_id, error)
+            failed.append({"id": item_id, "error": error})
+            return None
+
+        records = await asyncio.gather(*(build_record(raw, index) for index, raw in enumerate(questions)))
+        lines = [json.dumps(record) for record in records if record is not None]
+        report = {
+            "jobArn": None,
+            "records": len(lines),
+            "skipped": len(records) - len(lines) - len(failed),
+            "failed": failed,
+        }
+        if not lines:
+            return report
+
+        bucket, key = input_s3_uri[5:].split("/", 1)
+        await self._call_bedrock(
+            self._get_client('s3').put_object,
+            Bucket=bucket,
+            Key=key,
+            Body="\n".join(lines).encode("utf-8"),
+        )
+        response = await self._call_bedrock(
+            self._get_client('bedrock').create_model_invocation_job,
+            jobName=job_name or f"bedrock-kb-batch-{int(time.time())}",
+            roleArn=role_arn,
+            modelId=self.valves.model_id,
+            inputDataConfig={'s3InputDataConfig': {'s3Uri': input_s3_uri, 's3InputFormat': 'JSONL'}},
+            outputDataConfig={'s3OutputDataConfig': {'s3Uri': output_s3_uri}},
+        )
+        report["jobArn"] = response.get("jobArn")
+        return report
+
+    async def _stream_response(
+        self,
+        body: Dict[str, Any],
+        chunks: AsyncGenerator[str, None],
+        started_at: float,
+        __event_emitter__: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
+    ) -> AsyncGenerator[str, None]:
+        """
+        Stream the knowledge base answer back to OpenWebUI.
+        
+        Reports time-to-first-token through emit_status and appends the full answer
+        to the conversation once the stream is finished. If the client stops
+        reading early, the request's status is closed as stopped.
+        
+        Args:
+            body: The request body containing messages
+            chunks: Text deltas from stream_knowledge_base or stream_retrieve_and_generate
+            started_at: time.perf_counter() value taken when the request arrived
+            __event_emitter__: Function to emit events for status updates
+            
+        Yields:
+            Text deltas of the generated response
+        """
+        parts: List[str] = []
+        first_token = True
+        try:
+            async for text in chunks:
+                if first_token:
+                    first_token = False
+                    self._record_stage(__event_emitter__, "first_token", started_at)
+                    await self.emit_status(
+                        __event_emitter__,
+                        "info",
+                        f"First token in {(time.perf_counter() - started_at) * 1000:.0f} ms",
+                        False,
+                    )
+                parts.append(text)
+                yield text
+            body["messages"].append({"role": "assistant", "content": "".join(parts)})
+            await self.emit_status(__event_emitter__, "info", "Complete", True)
         except Exception as e:
-            error_message = f"Error querying knowledge base: {str(e)}"
-            return error_message
+            error_message = f"Error during knowledge base query: {str(e)}"
+            await self.emit_status(__event_emitter__, "error", error_message, True)
+            body["messages"].append({"role": "assistant", "content": error_message})
+            yield error_message
+        finally:
+            self._finish_status(__event_emitter__, "Stopped")
 
     async def pipe(
         self,
         body: Dict[str, Any],
-        user: Optional[Dict[str, Any]] = None,
+        __user__: Optional[Dict[str, Any]] = None,
         __event_emitter__: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
         __event_call__: Optional[Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]] = None,
-    ) -> Union[str, Dict[str, str]]:
+    ) -> Union[str, Dict[str, str], AsyncGenerator[str, None]]:
         """
         Main pipe function that processes the input and returns a response.
         
         This is the entry point for the AWS Bedrock Knowledge Base integration.
         It processes the input message, queries the knowledge base, and returns
-        a response based on the retrieved information.
+        a response based on the retrieved information. When streaming is enabled
+        it returns an async generator of text deltas instead.
         
         Args:
             body: The request body containing messages
-            user: User information (optional)
+            __user__: The OpenWebUI user (id, email, name, role, ...), used for $user
+                metadata filter variables (optional)
             __event_emitter__: Function to emit events for status updates
             __event_call__: Function to make event calls (not used in this implementation)
             
         Returns:
-            Either the generated response as a string or an error dictionary
+            The generated response as a string, an async generator of text deltas
+            when streaming is enabled, or an error dictionary
         """
+        started_at = time.perf_counter()
+        self.metrics.increment("requests_total", help_text="Requests handled by the pipe")
         await self.emit_status(
             __event_emitter__, "info", "Querying AWS Bedrock Knowledge Base...", False
         )
@@ -449,26 +4711,55 @@ class Pipe:
                     return {"error": error_message}
                     
                 # Check if Knowledge Base ID is provided
-                if not self.valves.knowledge_base_id:
+                if not self._knowledge_base_ids():
                     error_message = "Knowledge Base ID is not configured. Please set knowledge_base_id in the function settings."
                     await self.emit_status(__event_emitter__, "error", error_message, True)
                     body["messages"].append({"role": "assistant", "content": error_message})
                     return {"error": error_message}
                 
+                search_options = self._search_options(body, __user__)
+                
+                if self.valves.generation_mode == "retrieve_and_generate":
+                    # History lives in the Bedrock session, so it is not resent
+                    await self._sync_bedrock_session(messages, chat_id)
+                    await self.emit_status(
+                        __event_emitter__, "info", "Retrieving and generating with Knowledge Base...", False
+                    )
+                    if self.valves.enable_streaming:
+                        return self._stream_response(
+                            body, self.stream_retrieve_and_generate(question, chat_id, search_options), started_at, __event_emitter__
+                        )
+                    kb_response = await self.query_retrieve_and_generate(question, chat_id, search_options)
+                    body["messages"].append({"role": "assistant", "content": kb_response})
+                    await self.emit_status(__event_emitter__, "info", "Complete", True)
+                    return kb_response
+                
                 # Format conversation history if enabled
                 conversation_history = ""
                 if self.valves.use_conversation_history:
                     await self.emit_status(
                         __event_emitter__, "info", "Processing conversation history...", False
                     )
-                    conversation_history = self._format_conversation_history(messages)
+                    conversation_history = await self._chat_history(messages, chat_id)
                 
                 # Query the knowledge base
                 await self.emit_status(
                     __event_emitter__, "info", "Retrieving information from Knowledge Base...", False
                 )
                 
-                kb_response = await self.query_knowledge_base(question, chat_id, conversation_history)
+                if self.valves.enable_streaming:
+                    return self._stream_response(
+                        body,
+                        self.stream_knowledge_base(
+                            question, chat_id, conversation_history, __event_emitter__, search_options
+                        ),
+                        started_at,
+                        __event_emitter__,
+                    )
+                
+                kb_response = await self.query_knowledge_base(
+                    question, chat_id, conversation_history, __event_emitter__, search_options
+                )
                 
                 # Set assistant message with response
                 body["messages"].append({"role": "assistant", "content": kb_response})
@@ -476,6 +4767,10 @@ class Pipe:
                 await self.emit_status(__event_emitter__, "info", "Complete", True)
                 return kb_response
                 
+            except asyncio.CancelledError:
+                # The user aborted; close the status so the UI and the tracker do not linger
+                self._finish_status(__event_emitter__, "Stopped")
+                raise
             except Exception as e:
                 error_message = f"Error during knowledge base query: {str(e)}"
                 await self.emit_status(
@@ -0,0 +1,90 @@
+"""
+Tests for the AWS Bedrock Knowledge Base function, run with pytest.
+
+Bedrock is replaced by small in-process fakes pinned with Pipe.set_client, so
+no AWS credentials or network access are needed.
+"""
+import asyncio
+import io
+import json
+from typing import Any, Dict, List
+
+from aws_bedrock_kb_function import Pipe
+
+
+class FakeAgentRuntime:
+    """bedrock-agent-runtime stand-in that records retrieve requests."""
+
+    def __init__(self):
+        self.retrievals: List[Dict[str, Any]] = []
+
+    def retrieve(self, **kwargs: Any) -> Dict[str, Any]:
+        self.retrievals.append(kwargs)
+        return {"retrievalResults": [{"content": {"text": "Acme support is open 9-5."}, "score": 0.9}]}
+
+
+class FakeRuntime:
+    """bedrock-runtime stand-in that records invoke_model bodies and returns a fixed answer."""
+
+    def __init__(self):
+        self.bodies: List[Dict[str, Any]] = []
+
+    def invoke_model(self, modelId: str, body: str, **kwargs: Any) -> Dict[str, Any]:
+        request = json.loads(body)
+        self.bodies.append(request)
+        if "inferenceConfig" in request:
+            payload = {"output": {"message": {"content": [{"text": "answer"}]}}, "usage": {}}
+        else:
+            payload = {"content": [{"text": "answer"}], "usage": {}}
+        return {"body": io.BytesIO(json.dumps(payload).encode("utf-8"))}
+
+
+def make_pipe(**valves: Any) -> Pipe:
+    pipe = Pipe()
+    pipe.valves = pipe.Valves(
+        aws_access_key_id="test",
+        aws_secret_access_key="test",
+        knowledge_base_id="KB123",
+        enable_status_indicator=False,
+        **valves,
+    )
+    pipe.set_client("bedrock-agent-runtime", FakeAgentRuntime())
+    pipe.set_client("bedrock-runtime", FakeRuntime())
+    return pipe
+
+
+def test_pipe_resolves_user_filter_variables_from_openwebui_user():
+    pipe = make_pipe(metadata_filter="tenant = $user.tenant")
+    body = {"messages": [{"role": "user", "content": "When is support open?"}]}
+
+    async def emitter(event: Dict[str, Any]) -> None:
+        pass
+
+    # OpenWebUI passes the user as the __user__ keyword argument
+    answer = asyncio.run(
+        pipe.pipe(body, __user__={"id": "u1", "email": "a@acme.test", "tenant": "acme"}, __event_emitter__=emitter)
+    )
+
+    assert answer == "answer"
+    retrievals = pipe._get_client("bedrock-agent-runtime").retrievals
+    assert retrievals[0]["retrievalConfiguration"]["vectorSearchConfiguration"]["filter"] == {
+        "equals": {"key": "tenant", "value": "acme"}
+    }
+
+
+def run_pipe(pipe: Pipe) -> Dict[str, Any]:
+    body = {"messages": [{"role": "user", "content": "When is support open?"}]}
+    assert asyncio.run(pipe.pipe(body, __user__={"id": "u1"})) == "answer"
+    return pipe._get_client("bedrock-runtime").bodies[-1]
+
+
+def test_prompt_caching_marks_models_that_support_it():
+    pipe = make_pipe(enable_prompt_caching=True, model_id="us.anthropic.claude-3-7-sonnet-20250219-v1:0")
+
+    assert "cache_control" in json.dumps(run_pipe(pipe))
+
+
+def test_prompt_caching_sends_plain_prompt_to_other_models():
+    pipe = make_pipe(enable_prompt_caching=True, model_id="anthropic.claude-3-sonnet-20240229-v1:0")
+
+    assert "cache_control" not in json.dumps(run_pipe(pipe))